@@ -21,13 +21,82 @@
 
 MQTT_BROKER = "ha-server"               # the name of your MQTT broker
 MQTT_TOPIC = "my/+/stat/#"              # the topic to subscribe to, includes wildcards
-MQTT_PATTERN = r'my\/\w+\/stat\/(.+)'   # regular expression to extract the interesting part of topic
+# regular expressions for the topic prefix used by your gateways, which is followed by nid/cid/cmd/ack/typ.
+# Optional group 'gw' identifies the gateway
+MQTT_PATTERNS = [
+    r'my/(?P<gw>\w+)/stat/',
+    #r'(?P<gw>mygateway\d+)-out/',     # MySensors default
+]
+# older setting, one regular expression whose group 1 is nid/cid/cmd/ack/typ, e.g. r'my\/\w+\/stat\/(.+)'. 
+# If set, it is used instead of MQTT_PATTERNS
+MQTT_PATTERN = None
 DATABASE_FILE = 'mysensors.db'
 DB_DIR = '/var/lib/mytracker/'
+DB_BUSY_TIMEOUT = 10000                 # how long [ms] to wait for a database lock held by another connection
+DB_MAX_CONNECTIONS = 32                 # max. number of pooled database connections (web requests, ingest, maintenance)
+DEDUP_WINDOW = 1.0                      # messages with same topic and payload within this time [s] are duplicates
+DEDUP_MAX = 10000                       # max. number of recent messages remembered for duplicate detection
+INGEST_QUEUE_SIZE = 10000               # max. number of MQTT messages waiting to be written to the database
+INGEST_BATCH_SIZE = 500                 # max. number of messages written in one transaction
+LIVE_BUFFER = 100                       # max. number of messages waiting for one live viewer, slower viewers are dropped
+LIVE_MAX_CLIENTS = 50                   # max. number of live viewers
+LIVE_KEEPALIVE = 15.0                   # seconds between keep-alive comments on an idle live stream
+INGEST_FLUSH_INTERVAL = 0.5             # max. time [s] a message waits in the queue before it is written
+RETENTION_CHUNK = 10000                 # max. number of messages deleted in one transaction
+RETENTION_INTERVAL = 3600               # how often [s] to apply RETENTION_POLICY
+# automatic retention policy: days to keep messages, None = forever. Per command (C_SET=1, C_REQ=2, C_INTERNAL=3 ...),
+# with per-node overrides, e.g. {'default':365, 'commands':{1:90, 2:7, 3:30}, 'nodes':{123:{1:730}}}
+RETENTION_POLICY = {
+    'default': None,                    # for all messages not covered by a more specific rule
+    'commands': {},                     # command -> days
+    'nodes': {},                        # nid -> { command -> days }
+}
+REGISTRY_FLUSH_INTERVAL = 1.0           # how often [s] pending lastseen and current values are written to the database
+# numeric time series of C_SET values, for charts: (bucket size [s], days to keep or None = forever).
+# Bucket size 0 = raw samples, others keep min/max/avg per bucket, aligned to local time (sizes must divide a day)
+SERIES_TIERS = [
+    (0,     90),
+    (300,   730),
+    (3600,  None),
+    (86400, None),
+]
+EXPORT_CHUNK = 5000                     # rows per query when exporting, see export_rows()
+SERIES_MAX_POINTS = 500                 # queries use the finest tier that gives at most this many points
+STALE_FACTOR = 3.0                      # a node or sensor is overdue when silent for this many times its usual interval
+STALE_MIN = 120                         # ... but at least this many seconds
+STALE_MIN_INTERVALS = 3                 # a node or sensor is watched once this many intervals have been seen
+STALE_CHECK_INTERVAL = 5.0              # how often [s] to look for overdue nodes and sensors
+REBUILD_PROGRESS = 5.0                  # how often [s] rebuild_tvalues() reports progress
+COMPACT_MESSAGES = False                # store messages as integers and a payload dictionary, see compact_messages().
+                                        # Existing databases are converted at startup, this cannot be undone
+MESSAGE_SHARDS = False                  # move messages of past months to one database file per month, see MessageArchive
+SHARD_KEEP_MONTHS = 2                   # number of months, including the current one, kept in the main database
+COLD_AFTER_DAYS = None                  # compress messages older than this many days into blocks per node and day, 
+                                        # see ColdStore. None = never
+# indexes for the hot query shapes, (table, columns). Added to existing databases by migrate_indexes()
+INDEXES = [
+    ('message',   ('nid_id', 'cid', 'received')),   # /messages, /values, delete_sensor() for one sensor
+    ('message',   ('nid_id', 'received')),          # /messages, /values for one node, delete_node_requests()
+    ('message',   ('cmd', 'received')),             # /values, sorted by date
+    ('message',   ('received',)),                   # /messages sorted by date, delete_old_stuff()
+    ('valuetype', ('received',)),                   # delete_old_stuff()
+]
+# max. number of SQL statements per page, checked by `app.py check-queries`, and after each request 
+# if app.config['QUERY_BUDGET_STRICT'] is set
+QUERY_BUDGETS = { 'nodes': 2, 'sensors': 2, 'tvalues': 2, 'values': 3, 'messages': 3, 'stats': 2, 'stats_json': 2, 'series_json': 2, 
+                  'api_nodes': 1, 'api_sensors': 1, 'api_tvalues': 1, 'alerts': 0, 'alerts_json': 0, }
 REVISION = '$Id: app.py 1685 2024-11-27 11:19:02Z  $'
 
 import sys,re,time,os
+import argparse
 import math, json
+import csv, io
+import queue, threading
+import functools
+import contextlib
+import heapq
+import zlib
+import collections
 import logging
 import logging.config
 from datetime import datetime,timedelta
@@ -37,8 +106,9 @@ import flask                            # BSD license
 from flask import Flask,render_template,request,url_for,redirect
 from playhouse.flask_utils import FlaskDB
 from playhouse.hybrid import hybrid_property
-from playhouse.flask_utils import object_list
+from playhouse.flask_utils import object_list, PaginatedQuery
 from playhouse.migrate import *
+from playhouse.pool import PooledSqliteDatabase
 from playhouse.reflection import Introspector
 import wtforms as wtf                   # BSD license
 
@@ -133,11 +203,168 @@ def make_uvid(nid,cid,typ):
     """
     return 1000000 *typ + 1000*nid + cid
 
+##----------------------------------------------------------------------------
+
+def type_name(cmd,typ):
+    """look up symbolic name for type (sensor or value, depending on command)
+    Args:
+        cmd (int): MySensors command
+        typ (int): MySensors type
+    Returns:
+        string: symbolic name like S_DOOR or V_STATUS
+    """
+    if (cmd is None) or (typ is None): return None
+    if (cmd==mysensors.Commands.C_REQ) or (cmd==mysensors.Commands.C_SET):
+        return mysensors.value_names.get(typ)
+    elif (cmd==mysensors.Commands.C_PRESENTATION):
+        return mysensors.sensor_names.get(typ)
+    elif (cmd==mysensors.Commands.C_INTERNAL):
+        return mysensors.internal_names.get(typ)
+    else:
+        return None
+
+##----------------------------------------------------------------------------
+
+def usid_of_uvid(uvid):
+    """ SQL expression for the unique sensor id part of a unique value id. 
+        Note that `%` in a peewee expression means LIKE, not modulo
+    Args:
+        uvid (Field): field holding a unique value id
+    Returns:
+        Expression: uvid modulo 1000000
+    """
+    return Expression(uvid, '%', 1000000)
+
+##----------------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def value_types(values):
+    """ value types in a bitmask, as stored in Sensor.values. 
+        Cached, a database has only a few different combinations of value types
+    Args:
+        values (int): bit n set if value type n has been seen
+    Returns:
+        tuple: (type, symbolic name like V_STATUS) for each bit that is set, in order of type
+    """
+    return tuple( (typ, mysensors.value_names.get(typ)) for typ in range(values.bit_length()) if values >> typ & 1 )
+
 #endregion
 ##############################################################################
 #region Model definition
 
-db = SqliteDatabase(None)
+class TrackerDatabase(PooledSqliteDatabase):
+    """ SQLite database with a pool of connections, one per thread (web request, ingest writer,
+        maintenance job), in WAL mode so readers and the writer do not block each other. 
+        Counts SQL statements, per thread
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.counter = threading.local()
+        self.after = threading.local()          # actions to run when writer() commits, per thread
+
+    def execute_sql(self, sql, params=None):
+        self.counter.n = getattr(self.counter, 'n', 0) + 1
+        return super().execute_sql(sql, params)
+
+    @contextlib.contextmanager
+    def writer(self):
+        """ start a write transaction. Takes the write lock right away (BEGIN IMMEDIATE), 
+            so it waits for busy_timeout instead of failing when upgrading a read lock. 
+            Actions registered with after_commit() run when the outermost writer() has committed, 
+            and are dropped if the block they were registered in fails
+        """
+        actions = getattr(self.after, 'actions', None)
+        outer = actions is None
+        if outer:
+            actions = self.after.actions = []
+        mark = len(actions)
+        try:
+            with self.atomic('IMMEDIATE') as txn:
+                yield txn
+        except BaseException:
+            del actions[mark:]
+            raise
+        finally:
+            if outer:
+                self.after.actions = None
+        if outer:
+            for action, args in actions:
+                action(*args)
+
+    def after_commit(self, action, *args):
+        """ call action(*args) when the current writer() transaction has committed, 
+            or right away if there is none. For in-memory state that must match the database
+        """
+        actions = getattr(self.after, 'actions', None)
+        if actions is None:
+            action(*args)
+        else:
+            actions.append( (action, args) )
+
+    @property
+    def query_count(self):
+        """ number of SQL statements executed by current thread, since reset_query_count() """
+        return getattr(self.counter, 'n', 0)
+
+    @property
+    def shard_query_count(self):
+        """ how many of these were on archived messages, see ShardDatabase """
+        return getattr(self.counter, 'shard', 0)
+
+    def reset_query_count(self):
+        self.counter.n = 0
+        self.counter.shard = 0
+
+db = TrackerDatabase(None)
+
+class ShardDatabase(SqliteDatabase):
+    """ database file with archived messages, see MessageArchive and ColdStore. 
+        SQL statements are counted with those of `db`
+    """
+    def execute_sql(self, sql, params=None):
+        db.counter.n = getattr(db.counter, 'n', 0) + 1
+        db.counter.shard = getattr(db.counter, 'shard', 0) + 1
+        return super().execute_sql(sql, params)
+
+blockdb = ShardDatabase(None)
+
+class ValueTypesField(BigIntegerField):
+    """ set of value types as an integer bitmask, bit n set if value type n has been seen. 
+        Bit 63 is stored as the sign bit of an SQLite integer. 
+        Older databases have a BigBitField blob, see migrate_value_types()
+    """
+    BITS = 64
+
+    def db_value(self, value):
+        if value is not None and value >= 1 << (self.BITS-1):
+            value -= 1 << self.BITS
+        return super().db_value(value)
+
+    def python_value(self, value):
+        if isinstance(value, (bytes,bytearray)):
+            value = int.from_bytes(value, 'little')     # BigBitField, bit n of byte k is type 8*k+n
+        return (value or 0) & ((1 << self.BITS) - 1)
+
+class MessageTimeField(DateTimeField):
+    """ Message.received: a DateTimeField, or milliseconds since epoch (of the naive local time) 
+        once messages are stored in compact form, see compact_messages(). Comparisons with datetime 
+        values are then done on integers, in SQL as in the indexes
+    """
+    EPOCH = datetime(1970, 1, 1)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compact = False        # set by open_database()
+
+    def db_value(self, value):
+        if self.compact and isinstance(value, datetime):
+            return round( (value - self.EPOCH) / timedelta(milliseconds=1) )
+        return super().db_value(value)
+
+    def python_value(self, value):
+        if isinstance(value, int):
+            return self.EPOCH + timedelta(milliseconds=value)
+        return super().python_value(value)
 
 class BaseModel(Model):
     class Meta:
@@ -159,6 +386,9 @@ class Node(BaseModel):
     parent      = IntegerField(null=True,               help_text="parent node Id")
     arc         = IntegerField(null=True,               help_text="ARC success rate")
 
+    class Meta:
+        only_save_dirty = True      # cached by Registry, instances must not overwrite fields changed elsewhere
+
 
 class Sensor(BaseModel):    
     """ table describing MySensor sensors, 
@@ -169,9 +399,12 @@ class Sensor(BaseModel):
     cid         = IntegerField(                         help_text="MySensors child id")     # e.g. '11' (contact)
     typ         = IntegerField( null=True,              help_text="MySensors sensor type")  # e.g. '0'=S_DOOR
     name        = CharField( max_length=25, null=True,  help_text="sensor description")     # e.g. "Contact L"
-    values      = BigBitField( null=True,               help_text="which V_xxx types have been seen")
+    values      = ValueTypesField( default=0, null=True, help_text="which V_xxx types have been seen, bit n = type n")
     lastseen    = DateTimeField( default=datetime.now,  help_text="last message" )
 
+    class Meta:
+        only_save_dirty = True      # cached by Registry, instances must not overwrite fields changed elsewhere
+
 
 class ValueType(BaseModel):
     """ table describing a sensor sub-channel, as reported by type=V_xxx messages
@@ -185,6 +418,9 @@ class ValueType(BaseModel):
     value       = CharField( max_length=25, null=True,  help_text="Current value")
     received    = DateTimeField( default=datetime.now,  help_text="timestamp" )
 
+    class Meta:
+        only_save_dirty = True      # cached by Registry, instances must not overwrite fields changed elsewhere
+
     @hybrid_property
     def timestamp(self):
         return self.received.to_timestamp()
@@ -199,11 +435,12 @@ class Message(BaseModel):
     cmd         = IntegerField(                     help_text="MySensors command")
     typ         = IntegerField(                     help_text="MySensors type")
     payload     = CharField( max_length=25)
-    received    = DateTimeField(default=datetime.now, help_text="timestamp" )
+    received    = MessageTimeField(default=datetime.now, help_text="timestamp" )
+    gateway     = CharField( max_length=16, null=True, help_text="gateway that delivered the message")   # e.g. '2'
 
     @hybrid_property
     def usid(self):
-        return make_usid(self.nid.nid, self.cid)
+        return make_usid(self.nid_id, self.cid)
 
     @hybrid_property
     def value(self):
@@ -212,13 +449,898 @@ class Message(BaseModel):
     @hybrid_property
     def timestamp(self):
         return self.received.to_timestamp()
+
+
+class MessageBlock(Model):
+    """ table of compressed messages, one row per node and day, see ColdStore.
+        In a database file of its own, next to the main database
+    """
+    nid         = IntegerField(                         help_text="MySensors node id")
+    day         = DateField(                            help_text="date received")
+    count       = IntegerField(                         help_text="number of messages")
+    first       = DateTimeField(                        help_text="oldest message")
+    last        = DateTimeField(                        help_text="newest message")
+    size        = IntegerField(                         help_text="uncompressed size [bytes]")
+    data        = BlobField(                            help_text="messages as JSON, zlib-compressed")
+
+    class Meta:
+        database = blockdb
+        primary_key = CompositeKey('nid', 'day')
+        indexes = ( (('day',), False), )
+
+
+class MessageCount(BaseModel):
+    """ table of message counts per day, for one node, sensor or value type.
+        Maintained at ingest time by Rollup, not changed by deleting old messages
+    """
+    scope       = CharField( max_length=6,              help_text="'node', 'sensor' or 'value'")
+    key         = IntegerField(                         help_text="nid, usid or uvid")
+    day         = DateField(                            help_text="date received")
+    count       = IntegerField( default=0,              help_text="number of messages")
+
+    class Meta:
+        primary_key = CompositeKey('scope', 'key', 'day')
+
+
+class MessageStats(BaseModel):
+    """ table of running totals and intervals between messages, for one node, sensor or value type.
+        Maintained at ingest time by Rollup, not changed by deleting old messages
+    """
+    scope       = CharField( max_length=6,              help_text="'node', 'sensor' or 'value'")
+    key         = IntegerField(                         help_text="nid, usid or uvid")
+    count       = IntegerField( default=0,              help_text="number of messages")
+    first       = DateTimeField(                        help_text="first message")
+    last        = DateTimeField(                        help_text="latest message")
+    n_intervals = IntegerField( default=0,              help_text="number of intervals in sum_interval")
+    sum_interval= FloatField( default=0.0,              help_text="sum of intervals between messages [s]")
+    min_interval= FloatField( null=True,                help_text="shortest interval between messages [s]")
+    max_interval= FloatField( null=True,                help_text="longest interval between messages [s]")
+
+    class Meta:
+        primary_key = CompositeKey('scope', 'key')
+
+    @property
+    def avg_interval(self):
+        return self.sum_interval / self.n_intervals if self.n_intervals else None
+
+
+class Sample(BaseModel):
+    """ table of numeric values from C_SET messages, one row per message, for charts.
+        Raw tier of SeriesStore
+    """
+    uvid        = IntegerField(                         help_text="unique channel id")
+    ts          = FloatField(                           help_text="time received [s since epoch], with fraction")
+    value       = FloatField(                           help_text="payload as number")
+
+    class Meta:
+        primary_key = CompositeKey('uvid', 'ts')
+        without_rowid = True
+
+
+class SampleAgg(BaseModel):
+    """ table of numeric values from C_SET messages, downsampled to one row per time bucket.
+        Coarser tiers of SeriesStore
+    """
+    bucket      = IntegerField(                         help_text="bucket size [s]")
+    uvid        = IntegerField(                         help_text="unique channel id")
+    ts          = IntegerField(                         help_text="start of bucket [s since epoch]")
+    count       = IntegerField(                         help_text="number of samples")
+    vmin        = FloatField(                           help_text="smallest value")
+    vmax        = FloatField(                           help_text="largest value")
+    vsum        = FloatField(                           help_text="sum of values")
+
+    class Meta:
+        primary_key = CompositeKey('bucket', 'uvid', 'ts')
+        without_rowid = True
         
 
 #endregion
 ##############################################################################
 #region Model access
 #     
- 
+
+class Registry:
+    """ in-process cache of Node, Sensor and ValueType rows, keyed by nid, usid and uvid.
+        Answers "does this row exist" without a SELECT. 
+        The ingest path does not update rows directly: the latest lastseen and current value 
+        per key are kept in memory, and flush() writes them as one batch of upserts. 
+        Rarely changed fields (seen value types) are marked dirty and saved by flush(), too.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.nodes = {}         # nid -> Node
+        self.sensors = {}       # usid -> Sensor
+        self.tvalues = {}       # uvid -> ValueType
+        self.by_value = {}      # V_xxx type -> set of usid, from Sensor.values
+        self.dirty = {}         # instance -> set of field names to be saved
+        self.pending = self._empty()    # latest lastseen and values, not yet written
+        self.flushing = self._empty()   # being written by flush(), not yet committed
+        self.last_flush = time.monotonic()
+        self.version = 0                # incremented whenever nodes, sensors or values may have changed
+        self.started = int(time.time())
+
+    @staticmethod
+    def _empty():
+        return { 'nodes': {}, 'sensors': {}, 'tvalues': {} }
+
+    def load(self):
+        """ (re-)load all rows from database
+        """
+        with self.lock:
+            self.nodes = { node.nid: node for node in Node.select() }
+            self.sensors = { sensor.usid: sensor for sensor in Sensor.select() }
+            self.tvalues = { tvalue.uvid: tvalue for tvalue in ValueType.select() }
+            self.by_value = {}
+            for sensor in self.sensors.values():
+                for typ, name in value_types(sensor.values):
+                    self.by_value.setdefault(typ, set()).add(sensor.usid)
+            self.dirty = {}
+            self.pending = self._empty()
+        applog.info("registry: loaded %d nodes, %d sensors, %d values", 
+            len(self.nodes), len(self.sensors), len(self.tvalues))
+
+    def changed(self):
+        """ note that nodes, sensors or values may have changed, see etag()
+        """
+        with self.lock:
+            self.version += 1
+
+    def etag(self):
+        """ entity tag for the current state of nodes, sensors and values, for HTTP caching. 
+            Changes whenever changed() is called, and when the app is restarted
+        Returns:
+            str: entity tag
+        """
+        return "{0}-{1}".format(self.started, self.version)
+
+    def mark_dirty(self, instance, *fields):
+        """ remember that fields of a cached instance have to be written to the database
+        Args:
+            instance (Model): Node, Sensor or ValueType instance
+            fields (Field): fields that have been changed
+        """
+        with self.lock:
+            self.dirty.setdefault(instance, set()).update(f.name for f in fields)
+
+    def add_value_type(self, sensor, typ):
+        """ remember that a cached sensor has reported a value type, in Sensor.values 
+            (saved by flush()) and in the index used by sensors_with_value()
+        Args:
+            sensor (Sensor): cached instance
+            typ (int): MySensors V_xxx type
+        """
+        with self.lock:
+            sensor.values |= 1 << typ
+            self.by_value.setdefault(typ, set()).add(sensor.usid)
+            self.mark_dirty(sensor, Sensor.values)
+
+    def sensors_with_value(self, typ):
+        """ which sensors have reported a value type, without a query
+        Args:
+            typ (int): MySensors V_xxx type
+        Returns:
+            list: usid of sensors, sorted
+        """
+        with self.lock:
+            return sorted( self.by_value.get(typ, ()) )
+
+    def touch_node(self, nid, dt):
+        """ remember time of latest message from a node
+        Args:
+            nid (int): MySensors node ID
+            dt (datetime): time message was received
+        """
+        with self.lock:
+            self.pending['nodes'][nid] = {'nid':nid, 'lastseen':dt}
+
+    def touch_sensor(self, nid, cid, dt):
+        """ remember time of latest message from a sensor
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID
+            dt (datetime): time message was received
+        """
+        usid = make_usid(nid,cid)
+        with self.lock:
+            self.pending['sensors'][usid] = {'usid':usid, 'nid':nid, 'cid':cid, 'lastseen':dt}
+
+    def set_value(self, nid, cid, typ, val, dt):
+        """ remember latest value reported by a sensor
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID
+            typ (int): MySensors V_xxx type
+            val (str): payload
+            dt (datetime): time message was received
+        """
+        uvid = make_uvid(nid,cid,typ)
+        with self.lock:
+            self.pending['tvalues'][uvid] = {
+                'uvid':uvid, 'usid':make_usid(nid,cid), 'nid':nid, 'cid':cid, 'typ':typ, 
+                'value':val, 'received':dt }
+
+    def flush(self):
+        """ write pending lastseen and values, and all dirty fields, to the database, 
+            in one transaction
+        Returns:
+            int: number of rows written
+        """
+        with self.lock:
+            dirty, self.dirty = self.dirty, {}
+            self.flushing, self.pending = self.pending, self._empty()
+            flushing = self.flushing
+            self.last_flush = time.monotonic()
+        n = len(dirty) + sum( len(rows) for rows in flushing.values() )
+        try:
+            if n == 0:
+                return 0
+            with db.writer():
+                # taken inside the transaction: rows of nodes and sensors deleted by a transaction 
+                # that committed before this one started have been removed by _forget()
+                with self.lock:
+                    nodes, sensors, tvalues = ( list(flushing[kind].values()) for kind in ('nodes','sensors','tvalues') )
+                for rows in chunked( nodes, 100 ):
+                    Node.insert_many(rows).on_conflict(
+                        conflict_target=[Node.nid],
+                        update={Node.lastseen: fn.MAX(Node.lastseen, EXCLUDED.lastseen)}
+                        ).execute()
+                for rows in chunked( sensors, 100 ):
+                    Sensor.insert_many(rows).on_conflict(
+                        conflict_target=[Sensor.usid],
+                        update={Sensor.lastseen: fn.MAX(Sensor.lastseen, EXCLUDED.lastseen)}
+                        ).execute()
+                for rows in chunked( tvalues, 100 ):
+                    ValueType.insert_many(rows).on_conflict(
+                        conflict_target=[ValueType.uvid],
+                        update={ValueType.value: EXCLUDED.value, ValueType.received: EXCLUDED.received},
+                        where=(EXCLUDED.received >= ValueType.received)     # e.g. replay of an older capture
+                        ).execute()
+                for instance, names in dirty.items():
+                    instance.save( only=[instance._meta.fields[name] for name in names] )
+            applog.debug("registry: flushed %d rows", n)
+            return n
+        finally:
+            with self.lock:
+                self.flushing = self._empty()
+
+    def _latest(self, kind, key):
+        """ get pending (not yet committed) state for one row, or None
+        """
+        return self.pending[kind].get(key) or self.flushing[kind].get(key)
+
+    def overlay_nodes(self, rows):
+        """ patch Node rows read from database with pending lastseen and battery level
+        Args:
+            rows (list): Node instances, may have a `level` attribute
+        """
+        with self.lock:
+            for row in rows:
+                latest = self._latest('nodes', row.nid)
+                if latest is not None:
+                    row.lastseen = latest['lastseen']
+                latest = self._latest('tvalues', make_uvid(row.nid, 255, int(mysensors.Values.V_PERCENTAGE)))
+                if latest is not None and hasattr(row, 'level'):
+                    row.level = latest['value']
+
+    def overlay_sensors(self, rows):
+        """ patch Sensor rows read from database with pending lastseen
+        Args:
+            rows (list): Sensor instances
+        """
+        with self.lock:
+            for row in rows:
+                latest = self._latest('sensors', row.usid)
+                if latest is not None:
+                    row.lastseen = latest['lastseen']
+
+    def overlay_tvalues(self, rows):
+        """ patch ValueType rows read from database with pending values
+        Args:
+            rows (list): ValueType instances
+        """
+        with self.lock:
+            for row in rows:
+                latest = self._latest('tvalues', row.uvid)
+                if latest is not None:
+                    row.value = latest['value']
+                    row.received = latest['received']
+
+    def flush_if_due(self, interval=REGISTRY_FLUSH_INTERVAL):
+        """ flush(), if last flush was more than `interval` seconds ago
+        """
+        if time.monotonic() - self.last_flush >= interval:
+            self.flush()
+
+    def _forget(self, instances):
+        self.version += 1
+        for instance in instances:
+            self.dirty.pop(instance, None)
+            # otherwise flush() would re-create deleted rows, also a flush that is waiting for the write lock
+            if isinstance(instance, Node):
+                self.pending['nodes'].pop(instance.nid, None)
+                self.flushing['nodes'].pop(instance.nid, None)
+            elif isinstance(instance, Sensor):
+                self.pending['sensors'].pop(instance.usid, None)
+                self.flushing['sensors'].pop(instance.usid, None)
+                for typ, name in value_types(instance.values):
+                    self.by_value.get(typ, set()).discard(instance.usid)
+            elif isinstance(instance, ValueType):
+                self.pending['tvalues'].pop(instance.uvid, None)
+                self.flushing['tvalues'].pop(instance.uvid, None)
+
+    def _drop_unwritten(self, test):
+        """ drop pending and in-flight rows, also of instances that are not cached
+        Args:
+            test (callable): called with row dict, True if row is to be dropped
+        """
+        for state in (self.pending, self.flushing):
+            for rows in state.values():
+                for key in [key for key, row in rows.items() if test(row)]:
+                    del rows[key]
+
+    def evict_node(self, nid):
+        """ remove a node, and its sensors and values, from the cache
+        Args:
+            nid (int): MySensors node ID
+        """
+        with self.lock:
+            self._forget( [self.nodes.pop(nid)] if nid in self.nodes else [] )
+            self._forget( [self.sensors.pop(k) for k in [k for k,s in self.sensors.items() if s.nid_id==nid]] )
+            self._forget( [self.tvalues.pop(k) for k in [k for k,t in self.tvalues.items() if t.nid_id==nid]] )
+            self._drop_unwritten( lambda row: row['nid']==nid )
+
+    def evict_sensor(self, usid):
+        """ remove a sensor, and its values, from the cache
+        Args:
+            usid (int): unique sensor id
+        """
+        with self.lock:
+            self._forget( [self.sensors.pop(usid)] if usid in self.sensors else [] )
+            self._forget( [self.tvalues.pop(k) for k in [k for k,t in self.tvalues.items() if t.usid_id==usid]] )
+            self._drop_unwritten( lambda row: row.get('usid')==usid )
+
+    def evict_tvalues_before(self, cutoff):
+        """ remove all values received before `cutoff` from the cache
+        Args:
+            cutoff (datetime): oldest timestamp to keep
+        """
+        with self.lock:
+            self._forget( [self.tvalues.pop(k) for k in [k for k,t in self.tvalues.items() if t.received < cutoff]] )
+
+registry = Registry()
+
+##----------------------------------------------------------------------------
+
+class Rollup:
+    """ message counts per day, and intervals between messages, per node, sensor and value type 
+        (R014, R015, R021). add() only updates counters in memory, flush() adds them to the 
+        MessageCount and MessageStats tables as one batch of upserts, so /stats never has to 
+        scan the Message table. Deleting old messages does not change the rollups.
+    """
+    SCOPES = ('node', 'sensor', 'value')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.last = {}                  # (scope,key) -> time of latest message, for intervals
+        self.pending = self._empty()    # counts and intervals not yet written
+        self.flushing = self._empty()   # taken by flush(), not yet committed
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def _empty():
+        return { 'days': collections.Counter(), 'stats': {} }
+
+    def load(self):
+        """ (re-)load time of latest message per node, sensor and value type from database
+        """
+        with self.lock:
+            query = MessageStats.select(MessageStats.scope, MessageStats.key, MessageStats.last)
+            self.last = { (row.scope, row.key): row.last for row in query }
+            self.pending = self._empty()
+
+    def add(self, nid, cid, cmd, typ, dt):
+        """ count one message for its node and sensor, and for its value type if it is C_SET
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID
+            cmd (int): MySensors C_xxx command
+            typ (int): MySensors type
+            dt (datetime): time message was received
+        """
+        keys = [ ('node', nid), ('sensor', make_usid(nid,cid)) ]
+        if cmd == mysensors.Commands.C_SET:
+            keys.append( ('value', make_uvid(nid,cid,typ)) )
+        day = dt.date()
+        with self.lock:
+            days = self.pending['days']
+            stats = self.pending['stats']
+            for scope, key in keys:
+                days[(scope, key, day)] += 1
+                row = stats.get((scope, key))
+                if row is None:
+                    row = stats[(scope, key)] = {
+                        'scope':scope, 'key':key, 'count':0, 'first':dt, 'last':dt, 
+                        'n_intervals':0, 'sum_interval':0.0, 'min_interval':None, 'max_interval':None }
+                row['count'] += 1
+                row['first'] = min(row['first'], dt)
+                row['last'] = max(row['last'], dt)
+                last = self.last.get((scope, key))
+                # messages replayed out of order do not count as intervals
+                if last is not None and dt >= last:
+                    interval = (dt - last).total_seconds()
+                    row['n_intervals'] += 1
+                    row['sum_interval'] += interval
+                    if row['min_interval'] is None or interval < row['min_interval']:
+                        row['min_interval'] = interval
+                    if row['max_interval'] is None or interval > row['max_interval']:
+                        row['max_interval'] = interval
+                if last is None or dt > last:
+                    self.last[(scope, key)] = dt
+
+    def flush(self):
+        """ add pending counts and intervals to the database, in one transaction
+        Returns:
+            int: number of rows written
+        """
+        with self.lock:
+            self.flushing, self.pending = self.pending, self._empty()
+            flushing = self.flushing
+            self.last_flush = time.monotonic()
+        try:
+            if not flushing['stats']:
+                return 0
+            with db.writer():
+                # taken inside the transaction, see Registry.flush(): rollups of nodes and sensors 
+                # deleted by a transaction that committed before this one started have been removed by delete()
+                with self.lock:
+                    days = [ {'scope':scope, 'key':key, 'day':day, 'count':n} for (scope,key,day), n in flushing['days'].items() ]
+                    stats = list(flushing['stats'].values())
+                for rows in chunked(days, 100):
+                    MessageCount.insert_many(rows).on_conflict(
+                        conflict_target=[MessageCount.scope, MessageCount.key, MessageCount.day],
+                        update={MessageCount.count: MessageCount.count + EXCLUDED.count}
+                        ).execute()
+                for rows in chunked(stats, 100):
+                    MessageStats.insert_many(rows).on_conflict(
+                        conflict_target=[MessageStats.scope, MessageStats.key],
+                        update={
+                            MessageStats.count: MessageStats.count + EXCLUDED.count,
+                            MessageStats.first: fn.MIN(MessageStats.first, EXCLUDED.first),
+                            MessageStats.last: fn.MAX(MessageStats.last, EXCLUDED.last),
+                            MessageStats.n_intervals: MessageStats.n_intervals + EXCLUDED.n_intervals,
+                            MessageStats.sum_interval: MessageStats.sum_interval + EXCLUDED.sum_interval,
+                            # MIN() and MAX() of SQLite return NULL if any argument is NULL
+                            MessageStats.min_interval: fn.MIN(
+                                fn.COALESCE(MessageStats.min_interval, EXCLUDED.min_interval),
+                                fn.COALESCE(EXCLUDED.min_interval, MessageStats.min_interval)),
+                            MessageStats.max_interval: fn.MAX(
+                                fn.COALESCE(MessageStats.max_interval, EXCLUDED.max_interval),
+                                fn.COALESCE(EXCLUDED.max_interval, MessageStats.max_interval)),
+                        }).execute()
+            applog.debug("rollup: flushed %d counters", len(days)+len(stats))
+            return len(days)+len(stats)
+        finally:
+            with self.lock:
+                self.flushing = self._empty()
+
+    def flush_if_due(self, interval=REGISTRY_FLUSH_INTERVAL):
+        """ flush(), if last flush was more than `interval` seconds ago
+        """
+        if time.monotonic() - self.last_flush >= interval:
+            self.flush()
+
+    @staticmethod
+    def where_node(model, nid, cid=None):
+        """ condition selecting the rollup rows of a node, or of one sensor
+        Args:
+            model (Model): MessageCount or MessageStats
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID, or None for the node and all its sensors
+        Returns:
+            Expression: condition for where()
+        """
+        if cid is None:
+            lo, hi = make_usid(nid,0), make_usid(nid,999)
+        else:
+            lo = hi = make_usid(nid,cid)
+        where = ((model.scope=='sensor') & model.key.between(lo,hi)) | \
+                ((model.scope=='value') & usid_of_uvid(model.key).between(lo,hi))
+        if cid is None:
+            where |= ((model.scope=='node') & (model.key==nid))
+        return where
+
+    def delete(self, nid, cid=None):
+        """ delete the rollups of a node and its sensors, or of one sensor
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID, or None for the whole node
+        """
+        MessageCount.delete().where( self.where_node(MessageCount, nid, cid) ).execute()
+        MessageStats.delete().where( self.where_node(MessageStats, nid, cid) ).execute()
+
+        def matches(scope, key):
+            if scope == 'node':
+                return cid is None and key == nid
+            usid = key if scope == 'sensor' else key % 1000000
+            return usid == make_usid(nid,cid) if cid is not None else split_usid(usid)[0] == nid
+
+        with self.lock:
+            for k in [k for k in self.last if matches(*k)]:
+                del self.last[k]
+            for pending in (self.pending, self.flushing):
+                stats = pending['stats']
+                for k in [k for k in stats if matches(*k)]:
+                    del stats[k]
+                days = pending['days']
+                for k in [k for k in days if matches(k[0], k[1])]:
+                    del days[k]
+
+rollup = Rollup()
+
+##----------------------------------------------------------------------------
+
+class SeriesStore:
+    """ numeric time series of sensor values, for charts (UC002). 
+        C_SET payloads that parse as numbers are kept as (uvid, time, value) in table Sample, 
+        and downsampled to min/max/avg per bucket of each tier in SERIES_TIERS, in table SampleAgg. 
+        Like Rollup, add() only collects in memory and flush() writes one batch of upserts. 
+        query() picks the finest tier that covers the requested range with at most `max_points` points.
+    """
+
+    def __init__(self, tiers=SERIES_TIERS):
+        """
+        Args:
+            tiers (list): (bucket size [s], days to keep or None), see SERIES_TIERS
+        """
+        self.tiers = sorted(tiers)
+        self.buckets = [ bucket for bucket, keep in self.tiers if bucket > 0 ]
+        self.lock = threading.RLock()
+        self.pending = self._empty()
+        self.flushing = self._empty()   # taken by flush(), not yet committed
+        self.last_flush = time.monotonic()
+
+    @staticmethod
+    def _empty():
+        return { 'samples': {}, 'aggs': {} }
+
+    @staticmethod
+    def bucket_start(dt, bucket):
+        """ start of the bucket that contains a time. Buckets are aligned to local time, 
+            so daily buckets start at local midnight, also on days with a DST change
+        Args:
+            dt (datetime): local time
+            bucket (int): bucket size [s], divides a day
+        Returns:
+            int: start of bucket [s since epoch]
+        """
+        seconds = dt.hour*3600 + dt.minute*60 + dt.second
+        start = datetime.combine(dt.date(), datetime.min.time()) + timedelta(seconds=seconds - seconds % bucket)
+        return int(start.timestamp())
+
+    def add(self, nid, cid, typ, val, dt):
+        """ remember a value, if it is a number
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID
+            typ (int): MySensors V_xxx type
+            val (str): payload
+            dt (datetime): time message was received
+        """
+        try:
+            value = float(val)
+        except ValueError:
+            return
+        if not math.isfinite(value):
+            return
+        uvid = make_uvid(nid,cid,typ)
+        ts = dt.timestamp()             # with fraction, so every sample counted in the aggregates is kept
+        with self.lock:
+            self.pending['samples'][(uvid, ts)] = value
+            aggs = self.pending['aggs']
+            for bucket in self.buckets:
+                key = (bucket, uvid, self.bucket_start(dt, bucket))
+                agg = aggs.get(key)
+                if agg is None:
+                    aggs[key] = [1, value, value, value]
+                else:
+                    agg[0] += 1
+                    agg[1] = min(agg[1], value)
+                    agg[2] = max(agg[2], value)
+                    agg[3] += value
+
+    def flush(self):
+        """ write pending samples and aggregates to the database, in one transaction
+        Returns:
+            int: number of rows written
+        """
+        with self.lock:
+            self.flushing, self.pending = self.pending, self._empty()
+            flushing = self.flushing
+            self.last_flush = time.monotonic()
+        try:
+            if not flushing['samples']:
+                return 0
+            with db.writer():
+                # taken inside the transaction, see Rollup.flush()
+                with self.lock:
+                    samples = [ (uvid, ts, value) for (uvid, ts), value in flushing['samples'].items() ]
+                    aggs = [ (bucket, uvid, ts, n, vmin, vmax, vsum) 
+                             for (bucket, uvid, ts), (n, vmin, vmax, vsum) in flushing['aggs'].items() ]
+                for rows in chunked(samples, 300):
+                    Sample.insert_many(rows, fields=[Sample.uvid, Sample.ts, Sample.value]).on_conflict(
+                        conflict_target=[Sample.uvid, Sample.ts],
+                        update={Sample.value: EXCLUDED.value}
+                        ).execute()
+                for rows in chunked(aggs, 100):
+                    SampleAgg.insert_many(rows, fields=[SampleAgg.bucket, SampleAgg.uvid, SampleAgg.ts, 
+                            SampleAgg.count, SampleAgg.vmin, SampleAgg.vmax, SampleAgg.vsum]).on_conflict(
+                        conflict_target=[SampleAgg.bucket, SampleAgg.uvid, SampleAgg.ts],
+                        update={
+                            SampleAgg.count: SampleAgg.count + EXCLUDED.count,
+                            SampleAgg.vmin: fn.MIN(SampleAgg.vmin, EXCLUDED.vmin),
+                            SampleAgg.vmax: fn.MAX(SampleAgg.vmax, EXCLUDED.vmax),
+                            SampleAgg.vsum: SampleAgg.vsum + EXCLUDED.vsum,
+                        }).execute()
+            applog.debug("series: flushed %d samples, %d aggregates", len(samples), len(aggs))
+            return len(samples) + len(aggs)
+        finally:
+            with self.lock:
+                self.flushing = self._empty()
+
+    def flush_if_due(self, interval=REGISTRY_FLUSH_INTERVAL):
+        """ flush(), if last flush was more than `interval` seconds ago
+        """
+        if time.monotonic() - self.last_flush >= interval:
+            self.flush()
+
+    def query(self, uvid, start, end, max_points=SERIES_MAX_POINTS):
+        """ get values of one channel in a time range, at the finest resolution that 
+            gives at most `max_points` points and is still kept for the whole range
+        Args:
+            uvid (int): unique channel id
+            start (datetime): start of range
+            end (datetime): end of range
+            max_points (int): max. number of points
+        Returns:
+            tuple: (bucket size [s], 0 for raw samples, 
+                    list of (time [s since epoch], min, avg, max) tuples, oldest first)
+        """
+        t0, t1 = start.timestamp(), end.timestamp()
+        now = time.time()
+        for bucket, keep in self.tiers:
+            if keep is not None and t0 < now - keep*86400 and bucket != self.tiers[-1][0]:
+                continue
+            if bucket == 0:
+                rows = list( Sample.select(Sample.ts, Sample.value)
+                    .where( (Sample.uvid==uvid) & (Sample.ts.between(t0, t1)) )
+                    .order_by(Sample.ts).limit(max_points+1).tuples() )
+                if len(rows) <= max_points:
+                    return 0, [ (ts, v, v, v) for ts, v in rows ]
+            elif (t1 - t0) // bucket < max_points or bucket == self.tiers[-1][0]:
+                rows = ( SampleAgg.select(SampleAgg.ts, SampleAgg.vmin, SampleAgg.vsum, SampleAgg.count, SampleAgg.vmax)
+                    .where( (SampleAgg.bucket==bucket) & (SampleAgg.uvid==uvid) & 
+                            (SampleAgg.ts.between(self.bucket_start(start, bucket), t1)) )
+                    .order_by(SampleAgg.ts).tuples() )
+                return bucket, [ (ts, vmin, vsum/n, vmax) for ts, vmin, vsum, n, vmax in rows ]
+        return None, []
+
+    def delete_old(self):
+        """ delete samples and aggregates older than their tier is kept, see SERIES_TIERS
+        Returns:
+            int: number of rows deleted
+        """
+        now = time.time()
+        n = 0
+        for bucket, keep in self.tiers:
+            if keep is None:
+                continue
+            cutoff = int(now - keep*86400)
+            with db.writer():
+                if bucket == 0:
+                    n += Sample.delete().where(Sample.ts < cutoff).execute()
+                else:
+                    n += SampleAgg.delete().where( (SampleAgg.bucket==bucket) & (SampleAgg.ts < cutoff) ).execute()
+        applog.info("series: %d old samples and aggregates deleted", n)
+        return n
+
+    def delete(self, nid, cid=None):
+        """ delete the time series of a node, or of one sensor
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID, or None for the whole node
+        """
+        if cid is None:
+            lo, hi = make_usid(nid,0), make_usid(nid,999)
+        else:
+            lo = hi = make_usid(nid,cid)
+        Sample.delete().where( usid_of_uvid(Sample.uvid).between(lo,hi) ).execute()
+        SampleAgg.delete().where( usid_of_uvid(SampleAgg.uvid).between(lo,hi) ).execute()
+        with self.lock:
+            for kind in ('samples', 'aggs'):
+                for pending in (self.pending[kind], self.flushing[kind]):
+                    for k in [k for k in pending if lo <= k[-2] % 1000000 <= hi]:
+                        del pending[k]
+
+series = SeriesStore()
+
+##----------------------------------------------------------------------------
+
+class StaleDetector:
+    """ detects nodes and sensors that have stopped sending. 
+        For each node and sensor, the usual interval between messages is learned (initially from 
+        MessageStats, then as a moving average), and the time by which the next message is due 
+        is kept in a min-heap. A background thread pops deadlines that have passed, 
+        so finding overdue nodes costs O(log n) per alert, not a scan of all nodes. 
+        Current alerts are kept in a dict, which is all /alerts has to read.
+    """
+
+    def __init__(self, factor=STALE_FACTOR, minimum=STALE_MIN, alpha=0.1):
+        """
+        Args:
+            factor (float): overdue after `factor` times the usual interval
+            minimum (float): ... but not before `minimum` seconds
+            alpha (float): weight of the latest interval in the moving average
+        """
+        self.factor = factor
+        self.minimum = minimum
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.watched = {}       # (scope,key) -> [last message [s since epoch], usual interval [s] or None, number of intervals]
+        self.due = {}           # (scope,key) -> current deadline, heap entries with another deadline are outdated
+        self.heap = []          # (deadline, scope, key)
+        self.alerts = {}        # (scope,key) -> deadline that was missed
+        self._thread = None
+        self._stop = threading.Event()
+
+    def load(self):
+        """ (re-)load usual intervals and time of latest message from MessageStats
+        """
+        with self.lock:
+            self.watched, self.due, self.heap, self.alerts = {}, {}, [], {}
+            query = MessageStats.select().where(MessageStats.scope.in_(['node','sensor']))
+            for row in query:
+                self.watched[(row.scope, row.key)] = [row.last.timestamp(), row.avg_interval, row.n_intervals]
+                self._schedule( (row.scope, row.key) )
+        applog.info("watch: %d nodes and sensors watched", len(self.due))
+
+    def _schedule(self, key):
+        """ push deadline for next message, if the usual interval is known. Lock must be held
+        """
+        last, usual, n = self.watched[key]
+        if usual is None or n < STALE_MIN_INTERVALS:
+            return
+        deadline = last + max(self.factor*usual, self.minimum)
+        self.due[key] = deadline
+        heapq.heappush(self.heap, (deadline,) + key)
+        # outdated entries are skipped when popped; rebuild if they take over
+        if len(self.heap) > 4*len(self.due) + 1000:
+            self.heap = [ (d,) + k for k, d in self.due.items() ]
+            heapq.heapify(self.heap)
+
+    def seen(self, nid, cid, dt):
+        """ note a message from a node and sensor
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID
+            dt (datetime): time message was received
+        """
+        t = dt.timestamp()
+        with self.lock:
+            for key in ( ('node', nid), ('sensor', make_usid(nid,cid)) ):
+                state = self.watched.get(key)
+                if state is None:
+                    self.watched[key] = [t, None, 0]
+                    continue
+                last, usual, n = state
+                if t <= last:
+                    continue
+                n += 1
+                state[:] = [t, self._update(usual, t - last, n), n]
+                self.alerts.pop(key, None)
+                self._schedule(key)
+
+    def _update(self, usual, interval, n):
+        """ new usual interval, after another interval has been seen:
+            plain average until there are enough intervals, then moving average
+        """
+        if usual is None:
+            return interval
+        if n <= STALE_MIN_INTERVALS:
+            return usual + (interval - usual) / n
+        return usual + self.alpha * (interval - usual)
+
+    def check(self, now=None):
+        """ move nodes and sensors whose deadline has passed to alerts
+        Args:
+            now (float): current time [s since epoch], or None for now
+        Returns:
+            int: number of new alerts
+        """
+        now = time.time() if now is None else now
+        n = 0
+        with self.lock:
+            heap = self.heap
+            while heap and heap[0][0] <= now:
+                deadline, scope, key = heapq.heappop(heap)
+                if self.due.get((scope, key)) != deadline:
+                    continue
+                del self.due[(scope, key)]
+                self.alerts[(scope, key)] = deadline
+                n += 1
+        if n:
+            applog.info("watch: %d new alerts, %d in total", n, len(self.alerts))
+        return n
+
+    def current(self):
+        """ current alerts, longest overdue first
+        Returns:
+            list: dicts with scope, key, nid, cid, last message, usual interval [s] and deadline
+        """
+        with self.lock:
+            alerts = [ (deadline, scope, key, self.watched[(scope, key)]) for (scope, key), deadline in self.alerts.items() ]
+        alerts.sort()
+        result = []
+        for deadline, scope, key, (last, usual, n) in alerts:
+            nid, cid = (key, None) if scope == 'node' else split_usid(key)
+            result.append( dict( scope=scope, key=key, nid=nid, cid=cid, 
+                last=datetime.fromtimestamp(last), usual=usual, overdue=datetime.fromtimestamp(deadline) ) )
+        return result
+
+    def forget(self, nid, cid=None):
+        """ stop watching a node and its sensors, or one sensor
+        Args:
+            nid (int): MySensors node ID
+            cid (int): MySensors child ID, or None for the whole node
+        """
+        def matches(scope, key):
+            if scope == 'node':
+                return cid is None and key == nid
+            return key == make_usid(nid,cid) if cid is not None else split_usid(key)[0] == nid
+
+        with self.lock:
+            for k in [k for k in self.watched if matches(*k)]:
+                del self.watched[k]
+                self.due.pop(k, None)
+                self.alerts.pop(k, None)
+
+    def start(self, interval=STALE_CHECK_INTERVAL):
+        """ start background thread calling check() every `interval` seconds
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(interval,), name="watch", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.check()
+            except Exception:
+                applog.exception("error checking for overdue nodes")
+
+watch = StaleDetector()
+
+##----------------------------------------------------------------------------
+
+def flush_pending(force=False):
+    """ write what the ingest path collects in memory (registry, rollup, series) to the database
+    Args:
+        force (bool): if True flush everything, otherwise only what is due
+    """
+    for store in (registry, rollup, series):
+        if force:
+            store.flush()
+        else:
+            store.flush_if_due()
+
+##----------------------------------------------------------------------------
+
 def add_or_select_node(nid):
     """make sure node record exists, create if necessary
     Args:
@@ -226,7 +1348,13 @@ def add_or_select_node(nid):
     Returns:
         Node: instance
     """
-    node, create = Node.get_or_create(nid=nid)
+    with registry.lock:
+        node = registry.nodes.get(nid)
+    if node is None:
+        # no lock during the query, Registry.flush() takes the lock inside its transaction
+        node, create = Node.get_or_create(nid=nid)
+        with registry.lock:
+            node = registry.nodes.setdefault(nid, node)
     return node 
     
 ##----------------------------------------------------------------------------
@@ -239,10 +1367,16 @@ def add_or_select_sensor(nid,cid):
     Returns:
         Sensor:    instance
     """
-    sensor, create = Sensor.get_or_create(
-        usid=make_usid(nid,cid),
-        defaults={'nid':nid, 'cid':cid}
-        )
+    usid = make_usid(nid,cid)
+    with registry.lock:
+        sensor = registry.sensors.get(usid)
+    if sensor is None:
+        sensor, create = Sensor.get_or_create(
+            usid=usid,
+            defaults={'nid':nid, 'cid':cid}
+            )
+        with registry.lock:
+            sensor = registry.sensors.setdefault(usid, sensor)
     return sensor
 
 ##----------------------------------------------------------------------------
@@ -258,42 +1392,162 @@ def add_or_select_tvalue(nid,cid,typ,val=None,dt=None):
     Returns:
         ValueType:    instance
     """
-    tvalue, create = ValueType.get_or_create(
-        uvid=make_uvid(nid,cid,typ),
-        defaults={'nid':nid, 'cid':cid, 'typ':typ, 'usid':make_usid(nid,cid) }
-        )
-    if val is not None:
-        tvalue.value = val 
-    if dt is not None:
-        tvalue.received = dt
+    uvid = make_uvid(nid,cid,typ)
+    with registry.lock:
+        tvalue = registry.tvalues.get(uvid)
+    create = False
+    if tvalue is None:
+        tvalue, create = ValueType.get_or_create(
+            uvid=uvid,
+            defaults={'nid':nid, 'cid':cid, 'typ':typ, 'usid':make_usid(nid,cid) }
+            )
+    with registry.lock:
+        tvalue = registry.tvalues.setdefault(uvid, tvalue)
+        # a message older than the current value, e.g. from a replayed capture, does not replace it
+        if create or dt is None or tvalue.received is None or dt >= tvalue.received:
+            if val is not None:
+                tvalue.value = val 
+            if dt is not None:
+                tvalue.received = dt
     return tvalue
 
 ##----------------------------------------------------------------------------
 
-def fill_tvalues():
-    """ migrate older DB version by filling ValueType table from Message table
+def rebuild_tvalues(progress=REBUILD_PROGRESS):
+    """ recompute ValueType table (current value per sensor and value type) from messages, 
+        e.g. after upgrading from an older version, or if it has been damaged. 
+        One grouped query per database finds the latest C_SET message per value, and the latest battery level, 
+        which on_internal_message() stores as V_PERCENTAGE of child 255, instead of one sorted query 
+        per sensor and value type (in SQLite, the payload of a row with MAX(received) comes from the same message). 
+        Archived months and compressed messages are read as well. A value is only replaced by a newer one, 
+        so values whose messages have been deleted are kept. Value types found are added to Sensor.values. 
+        Runs in one transaction. Only sensors in the Sensor table are considered
+    Args:
+        progress (float): log progress every this many seconds
+    Returns:
+        int: number of values found
     """
-    query = Sensor.select().order_by(Sensor.usid)
-    for s in query:
-        for typ in range(64):
-            if s.values.is_set(typ):
-                try:
-                    msg = Message.select().where( 
-                            Message.nid == s.nid, 
-                            Message.cid == s.cid, 
-                            Message.cmd == mysensors.Commands.C_SET,
-                            Message.typ == typ
-                        ).order_by(Message.received.desc()).get()
-                    tvalue = add_or_select_tvalue(
-                                s.nid_id,
-                                s.cid,typ,
-                                msg.payload,
-                                msg.received )
-                    tvalue.save()
-                    applog.debug("added tvalue uvid:%d nid:%d cid:%d typ:%d = '%s'", 
-                        tvalue.uvid, s.nid_id, s.cid, typ, msg.payload )
-                except Message.DoesNotExist:
-                    pass
+    C_SET, C_INTERNAL = mysensors.Commands.C_SET, mysensors.Commands.C_INTERNAL
+    I_BATTERY_LEVEL, V_PERCENTAGE = int(mysensors.Internal.I_BATTERY_LEVEL), int(mysensors.Values.V_PERCENTAGE)
+    t0 = time.monotonic()
+    tlog = t0
+
+    def report():
+        # called by SQLite while the query runs
+        nonlocal tlog
+        if time.monotonic() - tlog >= progress:
+            tlog = time.monotonic()
+            applog.info("rebuild_tvalues: still scanning messages, %.0f s so far", tlog - t0)
+        return 0
+
+    sensors = set( usid for (usid,) in Sensor.select(Sensor.usid).tuples() )
+    found = {}      # uvid -> ValueType fields of the latest message
+
+    def add(nid, cid, typ, payload, received):
+        usid = make_usid(nid, cid)
+        uvid = make_uvid(nid, cid, typ)
+        if usid in sensors and (uvid not in found or received > found[uvid]['received']):
+            found[uvid] = dict(uvid=uvid, usid=usid, nid=nid, cid=cid, typ=typ, value=payload, received=received)
+
+    typ = Case(None, [ (Message.cmd==C_INTERNAL, V_PERCENTAGE) ], Message.typ)
+    latest = Message.select( 
+            Message.nid, Message.cid, typ, Message.payload, fn.MAX(Message.received) 
+        ).where( 
+            ( (Message.cmd==C_SET) & Message.typ.between(0, ValueTypesField.BITS-1) ) |
+            ( (Message.cmd==C_INTERNAL) & (Message.cid==255) & (Message.typ==I_BATTERY_LEVEL) )
+        ).group_by(Message.nid, Message.cid, typ)
+    with db.writer():
+        applog.info("rebuild_tvalues: scanning %d messages, please wait ...", Message.select().where(Message.cmd==C_SET).count())
+        db.connection().set_progress_handler(report, 100000)
+        try:
+            for row in latest.tuples():
+                add(*row)
+        finally:
+            db.connection().set_progress_handler(None, 0)
+        for query, month, end in archive.sources(latest):
+            applog.info("rebuild_tvalues: scanning archived month %s", "{0:%Y-%m}".format(month))
+            for row in query.tuples():
+                add(*row)
+        if cold.newest is not None:
+            applog.info("rebuild_tvalues: scanning %d compressed messages", cold.stats()['messages'])
+            for block in MessageBlock.select().order_by(MessageBlock.day.desc()).iterator():
+                for m in cold.decode(block):
+                    if m.cmd==C_SET and 0 <= m.typ < ValueTypesField.BITS:
+                        add(m.nid_id, m.cid, m.typ, m.payload, m.received)
+                    elif m.cmd==C_INTERNAL and m.cid==255 and m.typ==I_BATTERY_LEVEL:
+                        add(m.nid_id, m.cid, V_PERCENTAGE, m.payload, m.received)
+        n = len(found)
+        applog.info("rebuild_tvalues: %d values found after %.1f s, updating values and sensors", n, time.monotonic()-t0)
+
+        for batch in chunked( list(found.values()), 100 ):
+            ValueType.insert_many(batch).on_conflict(
+                conflict_target=[ValueType.uvid],
+                update={ValueType.value: EXCLUDED.value, ValueType.received: EXCLUDED.received},
+                where=(EXCLUDED.received >= ValueType.received) ).execute()
+        types = {}
+        for row in found.values():
+            types[row['usid']] = types.get(row['usid'], 0) | 1 << row['typ']
+        for sensor in Sensor.select(Sensor.usid, Sensor.values).where(Sensor.usid.in_(list(types))):
+            if types[sensor.usid] & ~sensor.values:
+                Sensor.update(values=sensor.values | types[sensor.usid]).where(Sensor.usid==sensor.usid).execute()
+    applog.info("rebuild_tvalues: done in %.1f s", time.monotonic()-t0)
+    return n
+
+##----------------------------------------------------------------------------
+
+def migrate_value_types():
+    """ migrate older DB version: Sensor.values was a BigBitField blob, convert it to an integer bitmask
+    Returns:
+        int: number of sensors converted
+    """
+    rows = list( Sensor.select(Sensor.usid, Sensor.values).where(fn.typeof(Sensor.values)=='blob') )
+    with db.atomic():
+        for row in rows:
+            Sensor.update(values=row.values).where(Sensor.usid==row.usid).execute()
+    applog.info("Migration: converted value types of %d sensors", len(rows))
+    return len(rows)
+
+##----------------------------------------------------------------------------
+
+def rebuild_stats():
+    """ recompute MessageCount and MessageStats tables from Message table, 
+        e.g. after upgrading from a version without them. Only counts messages still in the database
+    """
+    C_SET = mysensors.Commands.C_SET
+    scopes = [
+        ('node',    Message.nid,                                            None),
+        ('sensor',  Message.nid*1000 + Message.cid,                         None),
+        ('value',   Message.typ*1000000 + Message.nid*1000 + Message.cid,   Message.cmd==C_SET),
+    ]
+    t0 = time.monotonic()
+    with db.writer():
+        MessageCount.delete().execute()
+        MessageStats.delete().execute()
+        for scope, key, where in scopes:
+            applog.info("rebuild_stats: counting messages per %s, please wait ...", scope)
+            day = fn.date(*message_time(Message.received))
+            query = Message.select(Value(scope), key, day, fn.COUNT(Message.id))
+            if where is not None:
+                query = query.where(where)
+            MessageCount.insert_from(
+                query.group_by(key, day),
+                [MessageCount.scope, MessageCount.key, MessageCount.day, MessageCount.count] ).execute()
+
+            previous = fn.LAG(Message.received).over(partition_by=[key], order_by=[Message.received, Message.id])
+            interval = (fn.julianday(*message_time(Message.received)) - fn.julianday(*message_time(previous))) * 86400
+            inner = Message.select( key.alias('key'), Message.received.alias('received'), interval.alias('interval') )
+            if where is not None:
+                inner = inner.where(where)
+            query = inner.select_from(
+                Value(scope), inner.c.key, fn.COUNT(SQL('*')), message_datetime(fn.MIN(inner.c.received)), message_datetime(fn.MAX(inner.c.received)),
+                fn.COUNT(inner.c.interval), fn.COALESCE(fn.SUM(inner.c.interval), 0.0), 
+                fn.MIN(inner.c.interval), fn.MAX(inner.c.interval) ).group_by(inner.c.key)
+            MessageStats.insert_from( query, [
+                MessageStats.scope, MessageStats.key, MessageStats.count, MessageStats.first, MessageStats.last,
+                MessageStats.n_intervals, MessageStats.sum_interval, MessageStats.min_interval, MessageStats.max_interval] 
+                ).execute()
+    rollup.load()
+    applog.info("rebuild_stats: done in %.1f s", time.monotonic()-t0)
 
 ##----------------------------------------------------------------------------
 
@@ -306,6 +1560,7 @@ def new_battery( nid, date=datetime.today()):
     node = add_or_select_node(nid)
     node.bat_changed = date
     node.save()
+    registry.changed()
 
 ##----------------------------------------------------------------------------
 
@@ -314,28 +1569,44 @@ def delete_node( nid ):
     Args:
         nid (int): MySensors node ID
     """
-    with db.atomic() as txn:
-        applog.debug("Deleting node {0}".format(nid))
-        n = Message.delete().where(Message.nid==nid).execute()
-        applog.debug("{0} messages removed".format(n))
+    applog.debug("Deleting node {0}".format(nid))
+    # whole blocks first, then delete_messages() has none left to decompress
+    n = cold.delete_node(nid) + delete_messages(Message.nid==nid, nid=nid)
+    applog.debug("{0} messages removed".format(n))
+    with db.writer() as txn:
+        # messages received while deleting, and the node itself
+        Message.delete().where(Message.nid==nid).execute()
         n = ValueType.delete().where(ValueType.nid==nid).execute()
         applog.debug("{0} types removed".format(n))
         n = Sensor.delete().where(Sensor.nid==nid).execute()
         applog.debug("{0} sensors removed".format(n))
         n = Node.delete().where(Node.nid==nid).execute()
         applog.debug("{0} nodes removed".format(n))
+        rollup.delete(nid)
+        series.delete(nid)
+        # before commit, so a registry flush waiting for the write lock does not re-create the rows
+        registry.evict_node(nid)
+    watch.forget(nid)
 
 ##----------------------------------------------------------------------------
 
-def delete_node_requests( nid ):
+def delete_node_requests( nid, ndays=None ):
     """ delete all request messages for this node
     Args:
         nid (int): MySensors node ID
+        ndays (int): only delete requests older than this many days, or None for all
+    Returns:
+        int: number of messages deleted
     """
-    with db.atomic() as txn:
-        applog.debug("Deleting node requests {0}".format(nid))
-        n = Message.delete().where( (Message.nid==nid) & (Message.cmd == mysensors.Commands.C_REQ) ).execute()
-        applog.debug("{0} request messages removed".format(n))
+    applog.debug("Deleting node requests {0}".format(nid))
+    where = (Message.nid==nid) & (Message.cmd == mysensors.Commands.C_REQ)
+    cutoff = None
+    if ndays is not None:
+        cutoff = datetime.today()-timedelta(days=ndays)
+        where &= (Message.received < cutoff)
+    n = delete_messages(where, before=cutoff, nid=nid)
+    applog.debug("{0} request messages removed".format(n))
+    return n
 
 ##----------------------------------------------------------------------------
 
@@ -346,40 +1617,759 @@ def delete_sensor( nid, cid ):
         cid (int): MySensors child ID
     """
     usid = make_usid(nid,cid)
-    with db.atomic() as txn:
-        applog.debug("Deleting node {0} sensor {1}".format( nid, cid ))
-
-        n = Message.delete().where( (Message.nid==nid) & (Message.cid==cid) ).execute()
-        applog.debug("{0} messages removed".format(n))
+    applog.debug("Deleting node {0} sensor {1}".format( nid, cid ))
+    where = (Message.nid==nid) & (Message.cid==cid)
+    n = delete_messages(where, nid=nid)
+    applog.debug("{0} messages removed".format(n))
+    with db.writer() as txn:
+        # messages received while deleting, and the sensor itself
+        Message.delete().where(where).execute()
 
         n = ValueType.delete().where(ValueType.usid==usid).execute()
         applog.debug("{0} types removed".format(n))
 
         n = Sensor.delete().where(Sensor.usid==usid).execute()
         applog.debug("{0} sensors removed".format(n))
+        rollup.delete(nid, cid)
+        series.delete(nid, cid)
+        # before commit, see delete_node()
+        registry.evict_sensor(usid)
+    watch.forget(nid, cid)
 
 ##----------------------------------------------------------------------------
 
-def delete_old_stuff( ndays ):
+def month_start(dt):
+    """ first day of the month of `dt`, as datetime """
+    return datetime(dt.year, dt.month, 1)
+
+def next_month(month):
+    """ first day of the month after `month` """
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+
+class MessageArchive:
+    """ messages of past months, moved out of the main database into one SQLite file per month, 
+        named like the database file plus '-YYYY-MM'. Each file has a 'message' table like the 
+        main database, so the same Message queries run on it, see sources(). 
+        Deleting old messages drops whole months by deleting their file
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.prefix = None
+        self.shards = {}        # first day of month -> ShardDatabase
+
+    def open(self, dbpath):
+        """ find the monthly files of a database
+        Args:
+            dbpath (str): main database file
+        """
+        base = os.path.splitext(os.path.abspath(dbpath))[0]
+        self.prefix = base + '-'
+        pattern = re.compile(re.escape(os.path.basename(base)) + r'-(\d{4})-(\d{2})\.db$')
+        shards = {}
+        for name in os.listdir(os.path.dirname(base)):
+            m = pattern.match(name)
+            if m:
+                month = datetime(int(m.group(1)), int(m.group(2)), 1)
+                shards[month] = self._database(month)
+        with self.lock:
+            self.shards = shards
+        if shards:
+            applog.info("archive: %d months, %s to %s", len(shards), 
+                "{0:%Y-%m}".format(min(shards)), "{0:%Y-%m}".format(max(shards)))
+        if Message.received.compact:
+            self.compact_times()
+
+    def compact_times(self):
+        """ store `received` in the monthly files as milliseconds, like the main database in compact form. 
+            Files written before compact_messages() have text; they sort after integers, so the newest 
+            row of the index on `received` tells whether a file needs converting
+        Returns:
+            int: number of messages converted
+        """
+        with self.lock:
+            shards = sorted(self.shards.items())
+        total = 0
+        for month, shard in shards:
+            newest = shard.execute_sql('SELECT typeof("received") FROM "message" ORDER BY "received" DESC LIMIT 1').fetchone()
+            if newest is None or newest[0] != 'text':
+                continue
+            with shard.atomic():
+                n = shard.execute_sql('UPDATE "message" SET "received" = {0} WHERE typeof("received") = \'text\''.format(
+                    compact_ms('"received"'))).rowcount
+            applog.info("archive: %d messages of %s converted to compact form", n, "{0:%Y-%m}".format(month))
+            total += n
+        return total
+
+    def path(self, month):
+        return "{0}{1:%Y-%m}.db".format(self.prefix, month)
+
+    def _database(self, month):
+        return ShardDatabase(self.path(month), pragmas={ 'journal_mode': 'wal', 'busy_timeout': DB_BUSY_TIMEOUT })
+
+    def _create(self, month):
+        """ database file for a month, created if necessary
+        """
+        with self.lock:
+            shard = self.shards.get(month)
+        if shard is not None:
+            return shard
+        shard = self._database(month)
+        shard.execute_sql( *Message._schema._create_table(safe=True).query() )
+        for ctx in Message._schema._create_indexes(safe=True):
+            shard.execute_sql( *ctx.query() )
+        for table, columns in INDEXES:
+            if table == 'message':
+                shard.execute_sql( 'CREATE INDEX IF NOT EXISTS "message_{0}" ON "message" ({1})'.format(
+                    "_".join(columns), ", ".join('"{0}"'.format(c) for c in columns) ) )
+        with self.lock:
+            self.shards[month] = shard
+        return shard
+
+    def months(self):
+        """
+        Returns:
+            list: first day of each archived month, oldest first
+        """
+        with self.lock:
+            return sorted(self.shards)
+
+    def sources(self, query, since=None, until=None):
+        """ the same query, for each archived month that overlaps a time range
+        Args:
+            query (Query): Message query
+            since (datetime): start of range, or None
+            until (datetime): end of range, or None
+        Returns:
+            list: (query bound to the month's file, first day of month, first day of next month), newest first
+        """
+        with self.lock:
+            shards = sorted(self.shards.items(), reverse=True)
+        result = []
+        for month, shard in shards:
+            end = next_month(month)
+            if (since is None or end > since) and (until is None or month <= until):
+                result.append( (query.clone().bind(shard), month, end) )
+        return result
+
+    def archive(self, before, chunk=RETENTION_CHUNK):
+        """ move messages received before `before` from the main database to monthly files,
+            in chunks of `chunk` messages. A chunk is first written to the monthly file, then deleted
+            from the main database, so an interrupted run is completed by the next one
+        Args:
+            before (datetime): first day of a month
+            chunk (int): max. number of messages per transaction
+        Returns:
+            int: number of messages moved
+        """
+        total = 0
+        t0 = time.monotonic()
+        while True:
+            first = Message.select(Message.received).where(Message.received < before) \
+                .order_by(Message.received).limit(1).scalar()
+            if first is None:
+                break
+            month = month_start(first)
+            where = (Message.received >= month) & (Message.received < min(next_month(month), before))
+            shard = self._create(month)
+            n = 0
+            while True:
+                rows = list( Message.select().where(where).order_by(Message.id).limit(chunk).dicts() )
+                if not rows:
+                    break
+                with shard.atomic():
+                    Message.insert_many(rows).on_conflict_ignore().execute(shard)
+                with db.writer():
+                    Message.delete().where(Message.id.in_([ r['id'] for r in rows ])).execute()
+                n += len(rows)
+            applog.info("archive: %d messages moved to %s", n, self.path(month))
+            total += n
+        if total:
+            applog.info("archive: %d messages moved in %.1f s", total, time.monotonic()-t0)
+        return total
+
+    def archive_old(self, keep=SHARD_KEEP_MONTHS):
+        """ move messages to monthly files, except for the last `keep` months, including the current one
+        Returns:
+            int: number of messages moved
+        """
+        month = month_start(datetime.today())
+        for _ in range(keep-1):
+            month = month_start(month - timedelta(days=1))
+        return self.archive(month)
+
+    def drop_before(self, cutoff):
+        """ delete the files of months that end before `cutoff`
+        Returns:
+            int: number of months deleted
+        """
+        with self.lock:
+            months = [ m for m in self.shards if next_month(m) <= cutoff ]
+            dropped = [ self.shards.pop(m) for m in months ]
+        for month, shard in zip(months, dropped):
+            shard.close()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(self.path(month) + suffix):
+                    os.remove(self.path(month) + suffix)
+            applog.info("archive: %s deleted", self.path(month))
+        return len(months)
+
+    def delete(self, where):
+        """ delete messages matching a condition from all monthly files
+        Args:
+            where (Expression): condition on Message fields
+        Returns:
+            int: number of messages deleted
+        """
+        n = 0
+        for query, month, end in self.sources( Message.delete().where(where) ):
+            n += query.execute()
+        return n
+
+archive = MessageArchive()
+
+##----------------------------------------------------------------------------
+
+class ColdStore:
+    """ old messages, compressed in blocks of one node and one day, see MessageBlock.
+        A block is a JSON list of [id, cid, cmd, typ, payload, microseconds since midnight, gateway],
+        compressed with zlib. Blocks are read through sources(), which KeysetPage merges with 
+        the other sources of messages
+    """
+
+    def __init__(self, level=9):
+        """
+        Args:
+            level (int): zlib compression level
+        """
+        self.level = level
+        self.path = None
+        self.newest = None      # time of newest compressed message, None if there are none
+
+    def open(self, dbpath):
+        """ open the block database of a database, if there is one
+        Args:
+            dbpath (str): main database file
+        """
+        self.path = os.path.splitext(os.path.abspath(dbpath))[0] + '-cold.db'
+        if blockdb.database is not None:
+            blockdb.close()
+        blockdb.init(self.path, pragmas={ 'journal_mode': 'wal', 'busy_timeout': DB_BUSY_TIMEOUT })
+        self.newest = None
+        if os.path.exists(self.path):
+            self._refresh()
+            if self.newest is not None:
+                stats = self.stats()
+                applog.info("cold store: %d messages in %d blocks, %.1f MB compressed", 
+                    stats['messages'], stats['blocks'], stats['compressed']/1e6)
+
+    def _refresh(self):
+        blockdb.create_tables([MessageBlock])
+        self.newest = MessageBlock.select(MessageBlock.last).order_by(MessageBlock.last.desc()).limit(1).scalar()
+
+    def encode(self, nid, day, rows):
+        """ make a block
+        Args:
+            nid (int): MySensors node id
+            day (date): date received
+            rows (list): Message fields as dicts, e.g. from Message.select().dicts()
+        Returns:
+            dict: MessageBlock fields
+        """
+        midnight = datetime.combine(day, datetime.min.time())
+        rows = sorted(rows, key=lambda r: (r['received'], r['id']))
+        raw = json.dumps( [ [r['id'], r['cid'], r['cmd'], r['typ'], r['payload'], 
+                             (r['received']-midnight) // timedelta(microseconds=1), r['gateway']] for r in rows ],
+                          separators=(',',':') ).encode('utf-8')
+        return dict(nid=nid, day=day, count=len(rows), first=rows[0]['received'], last=rows[-1]['received'],
+                    size=len(raw), data=zlib.compress(raw, self.level))
+
+    def decode(self, block):
+        """ messages in a block
+        Args:
+            block (MessageBlock): block
+        Returns:
+            list: Message instances, not saved, oldest first
+        """
+        midnight = datetime.combine(block.day, datetime.min.time())
+        return [ Message(id=id, nid=block.nid, cid=cid, cmd=cmd, typ=typ, payload=payload, 
+                         received=midnight + timedelta(microseconds=us), gateway=gw)
+                 for id, cid, cmd, typ, payload, us, gw in json.loads(zlib.decompress(block.data)) ]
+
+    def compress(self, before, chunk=RETENTION_CHUNK):
+        """ move messages received before `before` from the main database to blocks, one day at a time. 
+            Messages of a node and day that already has a block, e.g. from replay, are added to it. 
+            Blocks are written before the messages are deleted, so an interrupted run is completed by the next one
+        Args:
+            before (datetime): midnight of a day
+            chunk (int): max. number of messages deleted per transaction
+        Returns:
+            dict: number of messages and blocks written, their size before and after compression
+        """
+        self._refresh()
+        result = dict(messages=0, blocks=0, size=0, compressed=0)
+        t0 = time.monotonic()
+        while True:
+            first = Message.select(Message.received).where(Message.received < before) \
+                .order_by(Message.received).limit(1).scalar()
+            if first is None:
+                break
+            day = first.date()
+            midnight = datetime.combine(day, datetime.min.time())
+            rows = list( Message.select().where( (Message.received >= midnight) & 
+                (Message.received < min(midnight + timedelta(days=1), before)) ).dicts() )
+            bynode = collections.defaultdict(dict)
+            for r in rows:
+                bynode[r['nid']][r['id']] = r
+            with blockdb.atomic():
+                query = MessageBlock.select().where( (MessageBlock.day == day) & MessageBlock.nid.in_(list(bynode)) )
+                for block in query:
+                    for m in self.decode(block):
+                        bynode[block.nid].setdefault(m.id, m.__data__)
+                blocks = [ self.encode(nid, day, list(noderows.values())) for nid, noderows in bynode.items() ]
+                for batch in chunked(blocks, 100):
+                    MessageBlock.insert_many(batch).on_conflict_replace().execute()
+            for ids in chunked([ r['id'] for r in rows ], chunk):
+                with db.writer():
+                    Message.delete().where(Message.id.in_(ids)).execute()
+            result['messages'] += len(rows)
+            result['blocks'] += len(blocks)
+            result['size'] += sum( b['size'] for b in blocks )
+            result['compressed'] += sum( len(b['data']) for b in blocks )
+        self._refresh()
+        if result['messages']:
+            applog.info("cold store: %d messages compressed into %d blocks in %.1f s, %.1f kB -> %.1f kB", 
+                result['messages'], result['blocks'], time.monotonic()-t0, result['size']/1e3, result['compressed']/1e3)
+        return result
+
+    def compress_old(self, ndays=COLD_AFTER_DAYS):
+        """ compress messages received more than `ndays` days ago, before midnight
+        Returns:
+            dict: see compress()
+        """
+        return self.compress( datetime.combine(datetime.today().date() - timedelta(days=ndays), datetime.min.time()) )
+
+    def stats(self):
+        """
+        Returns:
+            dict: number of messages and blocks, their size before and after compression
+        """
+        if self.newest is None:
+            return dict(messages=0, blocks=0, size=0, compressed=0)
+        messages, blocks, size, compressed = MessageBlock.select( fn.SUM(MessageBlock.count), fn.COUNT(MessageBlock.nid), 
+            fn.SUM(MessageBlock.size), fn.SUM(fn.LENGTH(MessageBlock.data)) ).tuples().get()
+        return dict(messages=messages or 0, blocks=blocks, size=size or 0, compressed=compressed or 0)
+
+    def sources(self, nid=None, cid=None, usid=None, cmd=None, typ=None):
+        """ compressed messages as a source for KeysetPage
+        Args:
+            nid, cid, usid (str): filters, see filter_messages()
+            cmd (int): only this command, or None
+            typ (str): only this type, or None
+        Returns:
+            list: (BlockSource, start, end), or empty if there are no blocks
+        """
+        if self.newest is None:
+            return []
+        return [ (BlockSource(nid, cid, usid, cmd, typ), datetime.min, self.newest + timedelta(microseconds=1)) ]
+
+    def drop_before(self, cutoff):
+        """ delete blocks of days before the day of `cutoff`
+        Returns:
+            int: number of messages deleted
+        """
+        if self.newest is None:
+            return 0
+        where = MessageBlock.day < cutoff.date()
+        n = MessageBlock.select(fn.SUM(MessageBlock.count)).where(where).scalar() or 0
+        MessageBlock.delete().where(where).execute()
+        self._refresh()
+        return n
+
+    def delete_node(self, nid):
+        """ delete all blocks of a node
+        Returns:
+            int: number of messages deleted
+        """
+        if self.newest is None:
+            return 0
+        where = MessageBlock.nid == nid
+        n = MessageBlock.select(fn.SUM(MessageBlock.count)).where(where).scalar() or 0
+        MessageBlock.delete().where(where).execute()
+        self._refresh()
+        return n
+
+    def delete(self, where, before=None, nid=None):
+        """ delete messages matching a condition from blocks. The condition is evaluated by SQLite, 
+            on the messages of one day at a time, decompressed into an in-memory table
+        Args:
+            where (Expression): condition on Message fields
+            before (datetime): only look at blocks with messages before this time, or None
+            nid (int): only look at blocks of this node, or None
+        Returns:
+            int: number of messages deleted
+        """
+        if self.newest is None:
+            return 0
+        query = MessageBlock.select(MessageBlock.day, MessageBlock.nid)
+        if before is not None:
+            query = query.where(MessageBlock.first < before)
+        if nid is not None:
+            query = query.where(MessageBlock.nid == nid)
+        days = collections.defaultdict(list)
+        for day, n in query.tuples():
+            days[day].append(n)
+        mem = SqliteDatabase(':memory:')
+        mem.execute_sql( *Message._schema._create_table().query() )
+        total = 0
+        for day, nids in sorted(days.items()):
+            with blockdb.atomic():
+                blocks = { b.nid: self.decode(b) for b in 
+                    MessageBlock.select().where( (MessageBlock.day == day) & MessageBlock.nid.in_(nids) ) }
+                mem.execute_sql('DELETE FROM "message"')
+                for batch in chunked( [ m.__data__ for msgs in blocks.values() for m in msgs ], 1000 ):
+                    Message.insert_many(batch).execute(mem)
+                ids = set( i for (i,) in Message.select(Message.id).where(where).tuples().execute(mem) )
+                if not ids:
+                    continue
+                for n, msgs in blocks.items():
+                    keep = [ m.__data__ for m in msgs if m.id not in ids ]
+                    if len(keep) == len(msgs):
+                        continue
+                    if keep:
+                        MessageBlock.insert(self.encode(n, day, keep)).on_conflict_replace().execute()
+                    else:
+                        MessageBlock.delete().where( (MessageBlock.day == day) & (MessageBlock.nid == n) ).execute()
+                total += len(ids)
+        mem.close()
+        if total:
+            self._refresh()
+        return total
+
+cold = ColdStore()
+
+
+class BlockSource:
+    """ compressed messages that match the filters of the /messages and /values pages, 
+        as a source for KeysetPage
+    """
+
+    def __init__(self, nid=None, cid=None, usid=None, cmd=None, typ=None):
+        """
+        Args:
+            nid, cid, usid (str): filters, see filter_messages()
+            cmd (int): only this command, or None
+            typ (str): only this type, or None
+        """
+        self.nid = None         # only read blocks of this node
+        tests = []
+        if usid is not None and len(usid)>0:
+            self.nid, icid = split_usid(int(usid))
+            tests.append( lambda m: m.cid == icid )
+        elif nid is not None and len(nid)>0:
+            inid = int(nid)
+            if inid >= 0:
+                self.nid = inid
+            else:
+                tests.append( lambda m: m.nid_id != -inid )
+        elif cid is not None and len(cid)>0:
+            icid = int(cid)
+            tests.append( (lambda m: m.cid == icid) if icid >= 0 else (lambda m: m.cid != -icid) )
+        if cmd is not None:
+            tests.append( lambda m: m.cmd == cmd )
+        if typ is not None and len(typ)>0:
+            ityp = int(typ)
+            tests.append( lambda m: m.typ == ityp )
+        self.tests = tests
+
+    def matches(self, m):
+        return all( test(m) for test in self.tests )
+
+    def approx_total(self):
+        """
+        Returns:
+            int: number of compressed messages, ignoring the filters
+        """
+        return MessageBlock.select( fn.SUM(MessageBlock.count) ).scalar() or 0
+
+    def keyset(self, cursor, ascending, limit):
+        """ messages after a cursor, one day of blocks at a time
+        Args:
+            cursor (tuple): (received, id), or None
+            ascending (bool): oldest first if True, else newest first
+            limit (int): max. number of messages
+        Returns:
+            list: Message instances, in the requested order
+        """
+        query = MessageBlock.select()
+        if self.nid is not None:
+            query = query.where(MessageBlock.nid == self.nid)
+        if cursor is not None:
+            query = query.where( (MessageBlock.last >= cursor[0]) if ascending else (MessageBlock.first <= cursor[0]) )
+        query = query.order_by( MessageBlock.day if ascending else MessageBlock.day.desc() )
+        rows = []
+        day = None
+        for block in query.iterator():
+            if block.day != day:
+                # days are disjoint, so rows of later days cannot come before these
+                if len(rows) >= limit:
+                    break
+                day = block.day
+            for m in cold.decode(block):
+                if self.matches(m) and (cursor is None or 
+                        ((m.received, m.id) > cursor if ascending else (m.received, m.id) < cursor)):
+                    rows.append(m)
+        rows.sort(key=lambda m: (m.received, m.id), reverse=not ascending)
+        return rows[:limit]
+
+    def export(self, columns, since=None, until=None):
+        """ messages in a time range, for export_chunks()
+        Args:
+            columns (list): field names
+            since, until (datetime): time range, or None
+        Yields:
+            list: tuples, one per message, for the blocks of one day
+        """
+        query = MessageBlock.select()
+        if self.nid is not None:
+            query = query.where(MessageBlock.nid == self.nid)
+        if since is not None:
+            query = query.where(MessageBlock.last >= since)
+        if until is not None:
+            query = query.where(MessageBlock.first < until)
+        rows = []
+        day = None
+        for block in list( query.order_by(MessageBlock.day, MessageBlock.nid) ):
+            if block.day != day and rows:
+                rows.sort()
+                yield rows
+                rows = []
+            day = block.day
+            rows += [ tuple( m.__data__[c] for c in columns ) for m in cold.decode(block) if self.matches(m) and 
+                      (since is None or m.received >= since) and (until is None or m.received < until) ]
+        if rows:
+            rows.sort()
+            yield rows
+
+##----------------------------------------------------------------------------
+
+def delete_messages( where, chunk=RETENTION_CHUNK, before=None, nid=None ):
+    """ delete all messages matching a condition, in chunks of at most `chunk` rows,
+        one transaction per chunk, so that the ingest writer is never locked out for long
+    Args:
+        where (Expression): condition on Message fields
+        chunk (int): max. number of rows per transaction
+        before (datetime): if all messages matching the condition were received before this time, 
+            only compressed blocks with older messages are searched
+        nid (int): if all messages matching the condition are from this node, only its blocks are searched
+    Returns:
+        int: number of messages deleted
+    """
+    total = 0
+    t0 = time.monotonic()
+    while True:
+        with db.writer():
+            # count ids here, a DELETE through the view of compact messages reports 0 rows
+            ids = [ m.id for m in Message.select(Message.id).where(where).limit(chunk) ]
+            if ids:
+                Message.delete().where(Message.id.in_(ids)).execute()
+        n = len(ids)
+        total += n
+        if n < chunk:
+            break
+        elapsed = time.monotonic() - t0
+        applog.info("{0} messages removed so far, {1:.0f} per second".format(total, total/elapsed))
+    total += archive.delete(where)
+    total += cold.delete(where, before, nid)
+    return total
+
+##----------------------------------------------------------------------------
+
+def delete_old_values( cutoff ):
+    """ delete current values last received before `cutoff`
+    Args:
+        cutoff (datetime): oldest timestamp to keep
+    Returns:
+        int: number of values deleted
+    """
+    with db.writer():
+        n = ValueType.delete().where( ValueType.received < cutoff ).execute()
+        registry.evict_tvalues_before(cutoff)
+    applog.debug("{0} values removed".format(n))
+    return n
+
+##----------------------------------------------------------------------------
+
+def delete_old_stuff( ndays, chunk=RETENTION_CHUNK ):
     """ delete everything older than `ndays` days 
     Args:
         ndays (int): no of days to keep
+        chunk (int): max. number of messages deleted per transaction
     """
-    cutoff = (datetime.today()-timedelta(days=ndays)).timestamp()
+    cutoff = datetime.today()-timedelta(days=ndays)
     applog.info("Deleting everything older than {0} days".format(ndays))
+    t0 = time.monotonic()
 
-    n = ValueType.delete().where( ValueType.timestamp < cutoff ).execute()
-    applog.debug("{0} values removed".format(n))
+    delete_old_values(cutoff)
 
-    n = Message.delete().where( Message.timestamp < cutoff ).execute()
-    applog.debug("{0} messages removed".format(n))
+    archive.drop_before(cutoff)
+    cold.drop_before(cutoff)
+    n = delete_messages( Message.received < cutoff, chunk, before=cutoff )
+    applog.info("{0} messages removed in {1:.1f} s".format(n, time.monotonic()-t0))
+
+##----------------------------------------------------------------------------
+
+def apply_retention_policy( policy=None ):
+    """ delete messages according to a retention policy, see RETENTION_POLICY.
+        The most specific rule wins: per node and command, then per command, then default.
+    Args:
+        policy (dict): retention policy, or None for RETENTION_POLICY
+    Returns:
+        dict: number of messages deleted, per rule
+    """
+    policy = RETENTION_POLICY if policy is None else policy
+    default = policy.get('default')
+    commands = policy.get('commands', {})
+    nodes = policy.get('nodes', {})
+    today = datetime.today()
+    t0 = time.monotonic()
+    counts = {}
+
+    # per node and command
+    overridden = []     # (nid,cmd) pairs with a node-specific rule
+    for nid, rules in nodes.items():
+        for cmd, ndays in rules.items():
+            overridden.append( (nid,cmd) )
+            if ndays is None:
+                continue
+            if cmd == mysensors.Commands.C_REQ:
+                n = delete_node_requests(nid, ndays)
+            else:
+                cutoff = today-timedelta(days=ndays)
+                n = delete_messages( (Message.nid==nid) & (Message.cmd==cmd) & (Message.received < cutoff), before=cutoff, nid=nid )
+            counts["node {0} {1}".format(nid, mysensors.command_names.get(cmd,cmd))] = n
+
+    # per command, except for nodes with their own rule
+    for cmd, ndays in commands.items():
+        if ndays is None:
+            continue
+        cutoff = today-timedelta(days=ndays)
+        where = (Message.cmd==cmd) & (Message.received < cutoff)
+        exempt = [nid for (nid,c) in overridden if c==cmd]
+        if exempt:
+            where &= Message.nid.not_in(exempt)
+        counts[mysensors.command_names.get(cmd,cmd)] = delete_messages(where, before=cutoff)
+
+    # everything else
+    if default is not None:
+        cutoff = today-timedelta(days=default)
+        where = (Message.received < cutoff)
+        if commands:
+            where &= Message.cmd.not_in( list(commands.keys()) )
+        for (nid,cmd) in overridden:
+            where &= ~( (Message.nid==nid) & (Message.cmd==cmd) )
+        counts['default'] = delete_messages(where, before=cutoff)
+        delete_old_values(cutoff)
+
+    applog.info("retention: {0} messages deleted in {1:.1f} s ({2})".format(
+        sum(counts.values()), time.monotonic()-t0,
+        ", ".join("{0}:{1}".format(rule,n) for rule,n in counts.items()) ))
+    return counts
+
+
+##----------------------------------------------------------------------------
+
+class Maintenance:
+    """ runs maintenance jobs, like deleting old messages, in a background thread, 
+        one at a time, either on request or periodically
+    """
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.waiting = set()        # names of submitted jobs not yet finished
+        self.periodic = []          # [next due time, interval, name, func, args]
+        self.running = None         # name of job currently running
+        self._thread = None
+
+    def start(self):
+        """ start background thread, if not already running
+        """
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="maintenance", daemon=True)
+                self._thread.start()
 
+    def submit(self, name, func, *args):
+        """ run a job in the background, as soon as possible
+        Args:
+            name (str): job name, a job is not submitted again while it is still waiting or running
+            func (callable): job function
+            args: arguments for func
+        Returns:
+            bool: True if job was submitted
+        """
+        with self.lock:
+            if name in self.waiting:
+                return False
+            self.waiting.add(name)
+        self.jobs.put( (name, func, args) )
+        self.start()
+        return True
+
+    def every(self, interval, name, func, *args):
+        """ run a job in the background periodically, the first time after `interval` seconds
+        Args:
+            interval (float): seconds between runs
+            name (str): job name
+            func (callable): job function
+            args: arguments for func
+        """
+        with self.lock:
+            self.periodic.append( [time.monotonic()+interval, interval, name, func, args] )
+        self.start()
+
+    def _run(self):
+        while True:
+            try:
+                name, func, args = self.jobs.get(timeout=1.0)
+                self._execute(name, func, args)
+                with self.lock:
+                    self.waiting.discard(name)
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            with self.lock:
+                due = [job for job in self.periodic if job[0] <= now]
+                for job in due:
+                    job[0] = now + job[1]
+            for job in due:
+                self._execute(job[2], job[3], job[4])
+
+    def _execute(self, name, func, args):
+        self.running = name
+        t0 = time.monotonic()
+        applog.info("maintenance: starting %s", name)
+        try:
+            db.connect(reuse_if_open=True)
+            func(*args)
+            applog.info("maintenance: %s finished in %.1f s", name, time.monotonic()-t0)
+        except Exception:
+            applog.exception("maintenance: %s failed", name)
+        finally:
+            self.running = None
+            if not db.is_closed():
+                db.close()
+
+maintenance = Maintenance()
 
 #endregion
 ##############################################################################
 #region MQTT message handling
       
-def add_message( nid,cid,cmd,typ,pay ):
+def add_message( nid,cid,cmd,typ,pay,dt=None,gw=None ):
     """ add a record to 'messages' table
     Args:
         nid (int): MySensors node ID
@@ -387,17 +2377,19 @@ def add_message( nid,cid,cmd,typ,pay ):
         cmd (int): MySensors C_xxx command
         typ (int): MySensors I_xxx type
         pay (string): payload
+        dt (datetime): time message was received, or None for now
+        gw (str): gateway that delivered the message, or None
     """
-    tnow = datetime.now()
+    tnow = dt if dt is not None else datetime.now()
 
-    node = add_or_select_node(nid)
-    node.lastseen = tnow
-    node.save()
-    sensor = add_or_select_sensor(nid,cid)
-    sensor.lastseen = tnow
-    sensor.save()
-    msg = Message.create(nid=nid,cid=cid,cmd=cmd,typ=typ,payload=pay)
-    msg.save()
+    add_or_select_node(nid)
+    db.after_commit(registry.touch_node, nid,tnow)
+    add_or_select_sensor(nid,cid)
+    db.after_commit(registry.touch_sensor, nid,cid,tnow)
+    Message.create(nid=nid,cid=cid,cmd=cmd,typ=typ,payload=pay,received=tnow,gateway=gw)
+    # not counted if the batch is rolled back and retried, see IngestWriter.write()
+    db.after_commit(rollup.add, nid,cid,cmd,typ,tnow)
+    db.after_commit(watch.seen, nid,cid,tnow)
 
 ##----------------------------------------------------------------------------
 
@@ -443,25 +2435,27 @@ def on_arc_message( nid,val ):
 
 ##----------------------------------------------------------------------------
 
-def on_value_message( nid,cid,typ,val ):
+def on_value_message( nid,cid,typ,val,dt=None ):
     """ add a record to 'values' table, for a sensor
     Args:
         nid (int): MySensors node ID
         cid (int): MySensors child ID
         typ (int): MySensors I_xxx type
         val (string): payload
+        dt (datetime): time message was received, or None for now
     """
     valname = mysensors.value_names.get(typ,"?")
 
     node = add_or_select_node(nid)       # make sure node exists
     
     sensor = add_or_select_sensor(nid,cid) # make sure sensor exists
-    if typ >= 0:
-        sensor.values.set_bit(typ)
-    sensor.save()
+    if 0 <= typ < ValueTypesField.BITS and not sensor.values >> typ & 1:
+        registry.add_value_type(sensor, typ)
     
-    tvalue = add_or_select_tvalue(nid,cid,typ,val,datetime.now())
-    tvalue.save()
+    tnow = dt if dt is not None else datetime.now()
+    tvalue = add_or_select_tvalue(nid,cid,typ,val,tnow)
+    db.after_commit(registry.set_value, nid,cid,typ,tvalue.value,tvalue.received)
+    db.after_commit(series.add, nid,cid,typ,val,tnow)      # the current value may be newer than this message
     
     # my convention: message sensor=98, type=47 is a report on parent node
     if (cid==98 and typ==47 and val.startswith('parent:')):
@@ -475,26 +2469,28 @@ def on_value_message( nid,cid,typ,val ):
 
 ##----------------------------------------------------------------------------
         
-def on_node_value_message( nid,typ,val ):
+def on_node_value_message( nid,typ,val,dt=None ):
     """ add a record to 'values' table, for sensor==255, i.e. node itself
     Args:
         nid (int): MySensors node ID
         typ (int): MySensors I_xxx type
         val (string): payload
+        dt (datetime): time message was received, or None for now
     """
     valname = mysensors.value_names.get(typ,"?")
     applog.debug("on_node_value_message( nid:%d typ:%d (%s) = '%s'", nid,typ,valname,val)
-    on_value_message( nid, 255, typ, val )
+    on_value_message( nid, 255, typ, val, dt )
 
 ##----------------------------------------------------------------------------
 
-def on_internal_message( nid, cid, typ, val ):
+def on_internal_message( nid, cid, typ, val, dt=None ):
     """handle INTERNAL messages
     Args:
         nid (int): MySensors node ID
         cid (int): MySensors child ID
         typ (int): MySensors I_xxx type
         val (string): payload
+        dt (datetime): time message was received, or None for now
     """
     typname = mysensors.internal_names.get(typ,"?")
     applog.debug("on_internal_message( nid:%d cid:%d typ:%d (%s) = '%s'", nid,cid,typ,typname,val)
@@ -522,7 +2518,7 @@ def on_internal_message( nid, cid, typ, val ):
         applog.debug("revision=%d", rev)
         node.save()
     elif (cid==255 and typ==mysensors.Internal.I_BATTERY_LEVEL):
-        on_node_value_message( nid, int(mysensors.Values.V_PERCENTAGE), val)
+        on_node_value_message( nid, int(mysensors.Values.V_PERCENTAGE), val, dt)
         return
     else:
         return
@@ -568,75 +2564,690 @@ def on_node_presentation_message( nid, typ, val ):
 
 ##----------------------------------------------------------------------------
 
-last_topic = ""
-last_payload = ""
-last_time = time.time()
+def handle_message( nid,cid,cmd,typ,val,dt=None,gw=None ):
+    """ store one MySensors message, and update node, sensor and value tables
+    Args:
+        nid (int): MySensors node ID
+        cid (int): MySensors child ID
+        cmd (int): MySensors C_xxx command
+        typ (int): MySensors type
+        val (string): payload
+        dt (datetime): time message was received, or None for now
+        gw (str): gateway that delivered the message, or None
+    """
+    add_message(nid,cid,cmd,typ,val,dt,gw)
+
+    if (cmd==mysensors.Commands.C_SET and cid!=255):
+        on_value_message(nid,cid,typ,val,dt)
+    elif (cmd==mysensors.Commands.C_SET and cid==255):
+        on_node_value_message(nid,typ,val,dt)
+    elif (cmd==mysensors.Commands.C_PRESENTATION and cid!=255):
+        on_presentation_message(nid,cid,typ,val)
+    elif (cmd==mysensors.Commands.C_PRESENTATION and cid==255):
+        on_node_presentation_message(nid,typ,val)
+    elif (cmd==mysensors.Commands.C_INTERNAL):
+        on_internal_message(nid,cid,typ,val,dt)
+
+##----------------------------------------------------------------------------
+
+class IngestWriter:
+    """ write-behind queue for incoming messages.
+        The MQTT callback only enqueues messages, a background thread drains 
+        the queue and writes messages in batches, one transaction per batch.
+    """
+
+    def __init__(self, maxsize=INGEST_QUEUE_SIZE, batch_size=INGEST_BATCH_SIZE, 
+                 flush_interval=INGEST_FLUSH_INTERVAL):
+        """
+        Args:
+            maxsize (int): max. number of messages waiting in queue
+            batch_size (int): max. number of messages per transaction
+            flush_interval (float): max. time [s] a message waits before it is written
+        """
+        self.queue = queue.Queue(maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.statements = 0                     # SQL statements executed by writer thread
+        self._thread = None
+        self._stop = threading.Event()
+
+    def put(self, item):
+        """ enqueue a message, never blocks. If the queue is full, the message is dropped
+        Args:
+            item (tuple): (nid,cid,cmd,typ,val,dt,gw) as expected by handle_message()
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                applog.warning("ingest queue full, %d messages dropped so far", self.dropped)
+
+    def start(self):
+        """ start background writer thread
+        """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="ingest", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ stop background writer thread, after writing whatever is still queued
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _collect(self):
+        """ wait for messages in queue, return up to `batch_size` of them, 
+            waiting at most `flush_interval` after the first one
+        Returns:
+            list: messages, may be empty
+        """
+        batch = []
+        try:
+            batch.append( self.queue.get(timeout=self.flush_interval) )
+        except queue.Empty:
+            return batch
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append( self.queue.get(timeout=remaining) )
+                else:
+                    batch.append( self.queue.get_nowait() )
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        # the one connection used for writing incoming messages, kept open while the thread runs
+        db.connect(reuse_if_open=True)
+        db.reset_query_count()
+        while not (self._stop.is_set() and self.queue.empty()):
+            batch = self._collect()
+            if batch:
+                self.write(batch)
+                registry.changed()
+            try:
+                flush_pending()
+            except Exception:
+                applog.exception("error flushing registry")
+            self.statements = db.query_count
+        flush_pending(force=True)
+        self.statements = db.query_count
+        db.close()
+
+    def write(self, batch):
+        """ write a batch of messages to the database, in one transaction.
+            If that fails, write them one by one, so a bad message does not spoil the whole batch
+        Args:
+            batch (list): list of (nid,cid,cmd,typ,val,dt,gw) tuples
+        """
+        try:
+            with db.writer():
+                for item in batch:
+                    handle_message(*item)
+            self.written += len(batch)
+            return
+        except Exception:
+            applog.exception("error writing batch of %d messages, retrying one by one", len(batch))
+        for item in batch:
+            try:
+                with db.writer():
+                    handle_message(*item)
+                self.written += 1
+            except Exception:
+                applog.exception("error writing message %s", item)
+
+ingest = IngestWriter()
+
+##----------------------------------------------------------------------------
+
+class ParsedMessage:
+    """ one MySensors message, as extracted from MQTT topic and payload
+    """
+    __slots__ = ('key', 'gw', 'nid', 'cid', 'cmd', 'typ', 'payload')
+
+    def __init__(self, key, gw, nid, cid, cmd, typ, payload):
+        self.key = key              # topic without gateway-specific prefix, e.g. '106/61/1/0/23'
+        self.gw = gw                # gateway, or None
+        self.nid = nid
+        self.cid = cid
+        self.cmd = cmd
+        self.typ = typ
+        self.payload = payload      # str
+
+##----------------------------------------------------------------------------
+
+class TopicParser:
+    """ extracts gateway, node id, child id, command and type from an MQTT topic. 
+        A pre-compiled regular expression per topic layout finds the prefix anywhere in the topic, 
+        like re.search() did, the rest of the topic is split into numbers. 
+        A pattern with an unnamed group 1, like MQTT_PATTERN, gives the rest as that group
+    """
+
+    def __init__(self, patterns=None):
+        """
+        Args:
+            patterns (list): regular expressions, or one as a string. 
+                Default is MQTT_PATTERN if it is set, else MQTT_PATTERNS
+        """
+        if patterns is None:
+            patterns = MQTT_PATTERN if MQTT_PATTERN is not None else MQTT_PATTERNS
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        self.patterns = [ (p, 'gw' in p.groupindex, p.groups > 0 and 1 not in p.groupindex.values()) 
+                          for p in map(re.compile, patterns) ]
+
+    def parse(self, topic, payload):
+        """ parse one MQTT message
+        Args:
+            topic (str): MQTT topic, e.g. 'my/3/stat/106/61/1/0/23'
+            payload (bytes): MQTT payload
+        Returns:
+            ParsedMessage: message, or None if topic does not match any layout
+        """
+        for pattern, hasgw, hasrest in self.patterns:
+            m = pattern.search(topic)
+            if m is not None:
+                break
+        else:
+            return None
+        key = m.group(1) if hasrest else topic[m.end():]
+        path = key.split('/')
+        if (len(path) < 5):
+            return None
+        try:
+            return ParsedMessage(
+                key, m.group('gw') if hasgw else None,
+                int(path[0]), int(path[1]), int(path[2]), int(path[4]),
+                payload.decode("utf-8") )
+        except ValueError:
+            return None
+
+topic_parser = TopicParser()
+
+##----------------------------------------------------------------------------
+
+class DedupWindow:
+    """ remembers messages seen in the last `window` seconds, keyed on (topic, payload), 
+        to drop copies of a message delivered by several gateways.
+        Entries expire in the order they were added, and at most `maxlen` are kept.
+    """
+
+    def __init__(self, window=DEDUP_WINDOW, maxlen=DEDUP_MAX):
+        """
+        Args:
+            window (float): time window [s]
+            maxlen (int): max. number of entries
+        """
+        self.window = window
+        self.maxlen = maxlen
+        self.seen = collections.OrderedDict()   # (topic,payload) -> time first seen, oldest first
+        self.accepted = collections.Counter()   # gateway -> number of messages stored
+        self.dropped = collections.Counter()    # gateway -> number of duplicates dropped
+
+    def is_new(self, topic, payload, gateway=None, now=None):
+        """ check if a message is new, or a duplicate of one seen recently
+        Args:
+            topic (str): topic, without gateway-specific prefix
+            payload (str): payload
+            gateway (str): gateway that delivered the message
+            now (float): time message was received, or None for now
+        Returns:
+            bool: True if new
+        """
+        now = time.time() if now is None else now
+        seen = self.seen
+        while seen:
+            key, first = next(iter(seen.items()))
+            if (now - first) <= self.window and len(seen) < self.maxlen:
+                break
+            seen.popitem(last=False)
+        key = (topic, payload)
+        if key in seen:
+            self.dropped[gateway] += 1
+            return False
+        seen[key] = now
+        self.accepted[gateway] += 1
+        return True
+
+    def stats(self):
+        """ per-gateway statistics
+        Returns:
+            list: (gateway, messages stored, duplicates dropped), sorted by gateway
+        """
+        gateways = set(self.accepted) | set(self.dropped)
+        return [ (gw, self.accepted[gw], self.dropped[gw]) for gw in sorted(gateways, key=str) ]
+
+dedup = DedupWindow()
+
+##----------------------------------------------------------------------------
+
+class LiveSubscriber:
+    """ one live viewer: a filter, and a bounded buffer of messages not yet sent
+    """
+    def __init__(self, nid=None, cid=None, cmd=None, maxsize=LIVE_BUFFER):
+        """
+        Args:
+            nid, cid, cmd (int): only messages with this node id, child id, command, or None for all
+            maxsize (int): max. number of messages waiting to be sent
+        """
+        self.nid = nid
+        self.cid = cid
+        self.cmd = cmd
+        self.queue = queue.Queue(maxsize)
+        self.dropped = False
+
+    def wants(self, nid, cid, cmd):
+        return (self.nid is None or self.nid==nid) and \
+               (self.cid is None or self.cid==cid) and \
+               (self.cmd is None or self.cmd==cmd)
+
+
+class LiveFeed:
+    """ fans out incoming messages to live viewers. publish() is called by on_message() and never blocks:
+        a viewer whose buffer is full is dropped, and gets no more messages
+    """
+    def __init__(self, maxclients=LIVE_MAX_CLIENTS):
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.maxclients = maxclients
+
+    def subscribe(self, nid=None, cid=None, cmd=None):
+        """ add a viewer
+        Returns:
+            LiveSubscriber: subscriber, or None if there are too many
+        """
+        with self.lock:
+            # viewers dropped before their stream started never unsubscribe themselves
+            active = [s for s in self.subscribers if not s.dropped]
+            if len(active) >= self.maxclients:
+                return None
+            sub = LiveSubscriber(nid, cid, cmd)
+            self.subscribers = active + [sub]
+        applog.info("live: viewer added, %d viewers", len(self.subscribers))
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers = [s for s in self.subscribers if s is not sub]
+        applog.info("live: viewer removed, %d viewers", len(self.subscribers))
+
+    def publish(self, rec, dt):
+        """ send a message to all viewers that want it
+        Args:
+            rec (ParsedMessage): message
+            dt (datetime): time received
+        """
+        subscribers = self.subscribers      # replaced, never changed in place, so no lock needed to read
+        if not subscribers:
+            return
+        item = None
+        for sub in subscribers:
+            if sub.dropped or not sub.wants(rec.nid, rec.cid, rec.cmd):
+                continue
+            if item is None:
+                item = json.dumps( dict(
+                    nid=rec.nid, cid=rec.cid, cmd=rec.cmd, typ=rec.typ, payload=rec.payload, gateway=rec.gw,
+                    received=dt.isoformat(), cmd_name=mysensors.command_names.get(rec.cmd), 
+                    typ_name=type_name(rec.cmd, rec.typ) ) )
+            try:
+                sub.queue.put_nowait(item)
+            except queue.Full:
+                sub.dropped = True
+                applog.warning("live: viewer too slow, dropped")
+
+    def stream(self, sub, keepalive=LIVE_KEEPALIVE):
+        """ Server-Sent Events for one viewer, until the viewer is dropped or disconnects
+        Args:
+            sub (LiveSubscriber): subscriber
+            keepalive (float): seconds between keep-alive comments when there are no messages
+        Yields:
+            str: SSE events
+        """
+        try:
+            yield "retry: 5000\n\n"
+            while not sub.dropped:
+                try:
+                    item = sub.queue.get(timeout=keepalive)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield "data: " + item + "\n\n"
+            yield "event: dropped\ndata: too slow\n\n"
+        finally:
+            self.unsubscribe(sub)
+
+live = LiveFeed()
+
+##----------------------------------------------------------------------------
 
 def on_message(mqttc, userdata, msg):
-    """MQTT callback function
+    """MQTT callback function, runs in paho network thread, only enqueues message
     Args:
         mqttc (mqtt.Client): client object
         userdata (n/a): n/a
         msg (MQTTMessage): topic and payload
     """
-    # example   my/3/stat/106/61/1/0/23 37
-    global last_topic, last_payload, last_time, applog
-    try:    
-        payload = msg.payload.decode("utf-8")
-        now = time.time()
-        m = re.search(MQTT_PATTERN,msg.topic)
-        if m is None:
-            return
-
-        topic = m.group(1)
-        path = topic.split('/')
-        if (len(path) < 5):
-            return
-
-        # remove duplicates
-        isnew = (last_topic != topic) or (last_payload != payload) or ((now - last_time) > 1)
-        last_topic = topic
-        last_payload = payload
-        last_time = now
-        if not isnew: return
-
-        nid = int(path[0])
-        cid = int(path[1])
-        cmd = int(path[2])
-        typ = int(path[4])
-        val = msg.payload.decode("utf-8")
-        applog.debug("message nid:%d cid:%d cmd:%d typ:%d = '%s'",nid,cid,cmd,typ,val)
-        add_message(nid,cid,cmd,typ,val)
-
-        if (cmd==mysensors.Commands.C_SET and cid!=255):
-            on_value_message(nid,cid,typ,val)
-        elif (cmd==mysensors.Commands.C_SET and cid==255):
-            on_node_value_message(nid,typ,val)
-        elif (cmd==mysensors.Commands.C_PRESENTATION and cid!=255):
-            on_presentation_message(nid,cid,typ,val)
-        elif (cmd==mysensors.Commands.C_PRESENTATION and cid==255):
-            on_node_presentation_message(nid,typ,val)
-        elif (cmd==mysensors.Commands.C_INTERNAL):
-            on_internal_message(nid,cid,typ,val)
-    except Exception as err:
-        print("Error: " + str(err))
-        sys.exit(1)
-        raise
+    # example   my/3/stat/106/61/1/0/23 37
+    global applog
+    try:    
+        rec = topic_parser.parse(msg.topic, msg.payload)
+        if rec is None:
+            return
+
+        # remove duplicates, e.g. same message received by several gateways
+        if not dedup.is_new(rec.key, rec.payload, rec.gw): 
+            return
+
+        applog.debug("message nid:%d cid:%d cmd:%d typ:%d = '%s'",rec.nid,rec.cid,rec.cmd,rec.typ,rec.payload)
+        dt = datetime.now()
+        ingest.put( (rec.nid,rec.cid,rec.cmd,rec.typ,rec.payload,dt,rec.gw) )
+        live.publish(rec, dt)
+    except Exception as err:
+        print("Error: " + str(err))
+        sys.exit(1)
+        raise
+
+##----------------------------------------------------------------------------
+
+def parse_timestamp(text):
+    """ parse a timestamp from a capture file
+    Args:
+        text (str): seconds since epoch like '1732636371.25', or ISO 8601 like '2024-11-26T16:52:51+0100'
+    Returns:
+        datetime: local time without timezone, like datetime.now(), or None if not a timestamp
+    """
+    try:
+        return datetime.fromtimestamp(float(text))
+    except ValueError:
+        pass
+    try:
+        dt = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+def parse_capture_line(line):
+    """ parse one line of captured MQTT traffic. Accepted formats are
+        `topic payload` as written by `mosquitto_sub -v`, 
+        `timestamp topic payload` as written by `mosquitto_sub -F '%U %t %p'` or `-F '%I %t %p'`,
+        and JSON objects with keys topic, payload and optionally ts
+    Args:
+        line (str): one line, without line end
+    Returns:
+        tuple: (topic, payload, dt) with dt None if there is no timestamp, or None for an empty line
+    """
+    if not line.strip():
+        return None
+    if line.startswith('{'):
+        obj = json.loads(line)
+        ts = obj.get('ts')
+        if ts is None:
+            dt = None
+        elif isinstance(ts, (int,float)):
+            dt = datetime.fromtimestamp(ts)
+        else:
+            dt = parse_timestamp(ts)
+        return (obj['topic'], obj.get('payload') or '', dt)
+    first, _, rest = line.partition(' ')
+    dt = parse_timestamp(first)
+    if dt is not None:
+        first, _, rest = rest.partition(' ')
+    return (first, rest, dt)
+
+def replay(file, batch_size=INGEST_BATCH_SIZE):
+    """ feed captured MQTT traffic through the same parsing, duplicate removal and 
+        message handling as live messages, as fast as possible, in batched transactions.
+        Messages keep their original timestamps if the capture has them, otherwise they get 
+        the current time and duplicates are not removed, as there is no way to tell them apart
+        from repeated messages.
+    Args:
+        file (iterable): lines in one of the formats accepted by parse_capture_line()
+        batch_size (int): messages per transaction
+    Returns:
+        dict: number of lines read, messages written, lines skipped, duplicates dropped, 
+              elapsed time [s], messages per second
+    """
+    writer = IngestWriter(batch_size=batch_size)
+    window = DedupWindow()
+    nlines = nskipped = nduplicates = 0
+    batch = []
+    t0 = time.monotonic()
+    for line in file:
+        nlines += 1
+        try:
+            item = parse_capture_line(line.rstrip('\r\n'))
+        except (ValueError, KeyError) as err:
+            applog.warning("line %d: %s", nlines, err)
+            item = None
+        if item is None:
+            nskipped += 1
+            continue
+        topic, payload, dt = item
+        rec = topic_parser.parse(topic, payload.encode("utf-8"))
+        if rec is None:
+            nskipped += 1
+            continue
+        if dt is not None and not window.is_new(rec.key, rec.payload, rec.gw, dt.timestamp()):
+            nduplicates += 1
+            continue
+        batch.append( (rec.nid,rec.cid,rec.cmd,rec.typ,rec.payload,dt or datetime.now(),rec.gw) )
+        if len(batch) >= batch_size:
+            writer.write(batch)
+            batch = []
+            flush_pending()
+            if writer.written % (100*batch_size) == 0:
+                applog.info("replay: %d messages written", writer.written)
+    if batch:
+        writer.write(batch)
+    flush_pending(force=True)
+    elapsed = time.monotonic() - t0
+    return dict(
+        lines=nlines, written=writer.written, skipped=nskipped, duplicates=nduplicates,
+        seconds=round(elapsed, 3), per_second=round(writer.written/elapsed, 1) if elapsed > 0 else None )
 
 #endregion  
 ##############################################################################
 #region Routes
 
+def overlay_list(template_name, query, overlay, **kwargs):
+    """ like playhouse.flask_utils.object_list(), but patches the rows of the current page 
+        with state that has not been written to the database yet
+    Args:
+        template_name (str): Jinja template
+        query (SelectQuery): query for all rows
+        overlay (callable): called with list of rows on current page
+    """
+    paginated_query = PaginatedQuery(query, paginate_by=20, check_bounds=True)
+    rows = list(paginated_query.get_object_list())
+    overlay(rows)
+    return render_template(
+        template_name,
+        object_list=rows,
+        pagination=paginated_query,
+        page=paginated_query.get_page(),
+        **kwargs)
+
+##----------------------------------------------------------------------------
+
 @app.route('/')
 def index():
-    return render_template('index.html', rev=REVISION[1:-1])
+    return render_template('index.html', rev=REVISION[1:-1], gateways=dedup.stats())
 
 ##----------------------------------------------------------------------------
 
-@app.route('/nodes')
-def nodes():
-    sort = flask.request.args.get('sort', default="nid", type=str)
+class KeysetPage:
+    """ one page of a query, newest first, using a cursor on (received,id) instead of LIMIT/OFFSET.
+        The cost of a page does not depend on how deep it is, and no COUNT(*) is needed.
+        A cursor is a string like '20241126165251000000-4711', or '0' for "before the oldest row".
+    """
+    START = '0'
+
+    def __init__(self, query, model, per_page=20, before=None, after=None, shards=()):
+        """
+        Args:
+            query (SelectQuery): filtered query, its order is replaced by (received,id) descending
+            model (Model): model with `received` and `id` fields
+            per_page (int): rows per page
+            before (str): cursor, show rows older than this, or None
+            after (str): cursor, show rows newer than this, or None. If both are None, show newest rows
+            shards (list): more sources of rows, as (query, start, end) for rows received 
+                in [start,end), see MessageArchive.sources(). Only those that overlap the page are queried. 
+                Instead of a query, a source may have a method keyset(cursor, ascending, limit), see BlockSource
+        """
+        self.query = query
+        self.model = model
+        key = Tuple(model.received, model.id)
+        # values in a Tuple are not converted by the field, see MessageTimeField. 
+        # The extra condition on `received` alone lets SQLite seek in the index on `received`
+        def cursorkey(received, id): return Tuple(model.received.to_value(received), id)
+        def older(received, id): return (model.received <= received) & (key < cursorkey(received, id))
+        def newer(received, id): return (model.received >= received) & (key > cursorkey(received, id))
+        def rowkey(row): return (row.received, row.id)
+        newest_first = (model.received.desc(), model.id.desc())
+        oldest_first = (model.received, model.id)
+        sources = [ (query, datetime.min, datetime.max) ] + list(shards)
+        self.sources = sources
+
+        def merge(cursor, order, ascending):
+            """ up to per_page+1 rows after cursor, from all sources. Sources are queried in the order
+                of their time range, until the remaining ones cannot contribute
+            """
+            rows = []
+            if ascending:
+                candidates = sorted( (s for s in sources if cursor is None or s[2] > cursor[0]), key=lambda s: s[1] )
+            else:
+                candidates = sorted( (s for s in sources if cursor is None or s[1] <= cursor[0]), key=lambda s: s[2], reverse=True )
+            for q, start, end in candidates:
+                if len(rows) > per_page and (rows[per_page].received < start if ascending else rows[per_page].received >= end):
+                    break
+                if hasattr(q, 'keyset'):
+                    more = q.keyset(cursor, ascending, per_page+1)
+                else:
+                    if cursor is not None:
+                        q = q.where( newer(*cursor) if ascending else older(*cursor) )
+                    more = list( q.order_by(*order).limit(per_page+1) )
+                rows = sorted( rows + more, key=rowkey, reverse=not ascending )[:per_page+1]
+            return rows
+
+        def exists(condition, row, ascending):
+            for q, start, end in sources:
+                if not (end > row.received if ascending else start <= row.received):
+                    continue
+                if q.keyset(rowkey(row), ascending, 1) if hasattr(q, 'keyset') else q.where(condition(*rowkey(row))).exists():
+                    return True
+            return False
+
+        if after is not None:
+            rows = merge(self.decode(after), oldest_first, True)
+            self.has_newer = len(rows) > per_page
+            rows = rows[:per_page]
+            rows.reverse()
+            self.has_older = bool(rows) and exists(older, rows[-1], False)
+        else:
+            rows = merge(self.decode(before) if before is not None else None, newest_first, False)
+            self.has_older = len(rows) > per_page
+            rows = rows[:per_page]
+            self.has_newer = bool(rows) and before is not None and exists(newer, rows[0], True)
+        self.rows = rows
+
+    @staticmethod
+    def encode(row):
+        """ make cursor string from a row
+        """
+        return "{0}-{1}".format(row.received.strftime('%Y%m%d%H%M%S%f'), row.id)
+
+    @classmethod
+    def decode(cls, cursor):
+        """ parse cursor string
+        Returns:
+            tuple: (received, id)
+        Raises:
+            ValueError: if the cursor is malformed
+        """
+        if cursor == cls.START:
+            return (datetime.min, 0)
+        ts, id = cursor.split('-')
+        return (datetime.strptime(ts, '%Y%m%d%H%M%S%f'), int(id))
+
+    @property
+    def newer(self):
+        """ cursor for link to previous (newer) page, or None """
+        return self.encode(self.rows[0]) if self.has_newer else None
+
+    @property
+    def older(self):
+        """ cursor for link to next (older) page, or None """
+        return self.encode(self.rows[-1]) if self.has_older else None
+
+    def approx_total(self):
+        """ estimate total number of rows in table and shards, from the range of ids in each. Cheap, 
+            but only meaningful for an unfiltered query
+        Returns:
+            int: estimated number of rows
+        """
+        total = 0
+        for q, start, end in self.sources:
+            if hasattr(q, 'approx_total'):
+                total += q.approx_total()
+                continue
+            total += self.model.select( fn.MAX(self.model.id) - fn.MIN(self.model.id) + 1 ).scalar(q._database) or 0
+        return total
+
+##----------------------------------------------------------------------------
+
+def keyset_list(template_name, query, model, approx_total=False, shards=(), **kwargs):
+    """ like playhouse.flask_utils.object_list(), but with KeysetPage pagination, 
+        using `before` and `after` request parameters
+    Args:
+        template_name (str): Jinja template
+        query (SelectQuery): filtered query
+        model (Model): model with `received` and `id` fields
+        approx_total (bool): if True, pass an estimated total number of rows to template as `total`
+        shards (list): more sources of rows, see KeysetPage
+    """
+    before = request.args.get('before', default=None, type=str)
+    after = request.args.get('after', default=None, type=str)
+    for cursor in (before, after):
+        try:
+            if cursor is not None:
+                KeysetPage.decode(cursor)
+        except ValueError:
+            flask.abort(400, "malformed cursor '{0}'".format(cursor))
+    pager = KeysetPage( query, model, before=before, after=after, shards=shards )
+    return render_template(
+        template_name,
+        object_list=pager.rows,
+        pager=pager,
+        total=pager.approx_total() if approx_total else None,
+        **kwargs)
+
+def unlisted_messages():
+    """ messages not shown by pages that are not sorted by date, and use object_list() 
+        on the main database only, for a notice on the page
+    Returns:
+        dict: `months`, list of archived months, oldest first, 
+              and `compressed`, time of the newest message in the cold store, or None
+    """
+    return dict(months=archive.months(), compressed=cold.newest)
 
+##----------------------------------------------------------------------------
+
+def nodes_query(sort):
+    """ query for /nodes page
+    Args:
+        sort (str): 'nid' or 'date'
+    Returns:
+        SelectQuery: Node rows, with battery level as `level`
+    """
     query = Node.select(Node,ValueType.value.alias('level')).join(
                 ValueType, 
                 JOIN.LEFT_OUTER, 
@@ -651,17 +3262,26 @@ def nodes():
         query = query.order_by(Node.lastseen.desc())
     else:
         query = query.order_by(Node.nid)
-    return object_list('nodes.html', query.objects(), sort=sort )
+    return query
 
-##----------------------------------------------------------------------------
+@app.route('/nodes')
+def nodes():
+    sort = flask.request.args.get('sort', default="nid", type=str)
+    query = nodes_query(sort)
+    return overlay_list('nodes.html', query.objects(), registry.overlay_nodes, sort=sort )
 
-@app.route('/sensors')
-def sensors():
-    sort = flask.request.args.get('sort', default="usid", type=str)
-    cid = flask.request.args.get('cid', default=None, type=int)
-    nid = flask.request.args.get('nid', default=None, type=int)
+##----------------------------------------------------------------------------
 
-    query = Sensor.select().join(Node)
+def sensors_query(sort, nid=None, typ=None):
+    """ query for /sensors page
+    Args:
+        sort (str): 'usid', 'cid' or 'date'
+        nid (int): only this node if >=0, all but this node if <0, or None
+        typ (int): only sensors that have reported this V_xxx type, or None
+    Returns:
+        SelectQuery: Sensor rows
+    """
+    query = Sensor.select(Sensor, Node).join(Node)
 
     # sort as requested
     if sort=="cid": 
@@ -677,19 +3297,35 @@ def sensors():
             query = query.where(Sensor.nid==nid)
         else:
             query = query.where(Sensor.nid!=-nid)
-    return object_list( 'sensors.html', query, sort=sort, nid=nid, cid=cid )
 
-##----------------------------------------------------------------------------
+    # filter by value type: primary keys from the registry, instead of reading Sensor.values of all rows
+    if typ is not None:
+        query = query.where(Sensor.usid.in_(registry.sensors_with_value(typ)))
+    return query
 
-@app.route('/tvalues')
-def tvalues():
-    # get parameters
+@app.route('/sensors')
+def sensors():
     sort = flask.request.args.get('sort', default="usid", type=str)
-    nid = flask.request.args.get('nid', default=None, type=str)
-    cid = flask.request.args.get('cid', default=None, type=str)
-    usid = flask.request.args.get('usid', default=None, type=str)
+    cid = flask.request.args.get('cid', default=None, type=int)
+    nid = flask.request.args.get('nid', default=None, type=int)
+    typ = flask.request.args.get('typ', default=None, type=int)
+
+    query = sensors_query(sort, nid, typ)
+    return overlay_list( 'sensors.html', query, registry.overlay_sensors, sort=sort, nid=nid, cid=cid, typ=typ )
+
+##----------------------------------------------------------------------------
 
-    query = ValueType.select().join(Node).switch(ValueType).join(Sensor)
+def tvalues_query(sort, nid=None, cid=None, usid=None):
+    """ query for /tvalues page
+    Args:
+        sort (str): 'usid', 'cid' or 'date'
+        nid (str): node id filter, '-' prefix means "all but", or None
+        cid (str): child id filter, '-' prefix means "all but", or None
+        usid (str): unique sensor id filter, or None
+    Returns:
+        SelectQuery: ValueType rows
+    """
+    query = ValueType.select(ValueType, Node, Sensor).join(Node).switch(ValueType).join(Sensor)
 
     # sort as requested
     if sort=="cid": 
@@ -715,29 +3351,31 @@ def tvalues():
             query = query.where(ValueType.cid==icid)
         else:
             query = query.where(ValueType.cid!=-icid)
-    return object_list( 'types.html', query, sort=sort, nid=nid, cid=cid, usid=usid )
-
-##----------------------------------------------------------------------------
+    return query
 
-@app.route('/values')
-def values():
+@app.route('/tvalues')
+def tvalues():
     # get parameters
     sort = flask.request.args.get('sort', default="usid", type=str)
     nid = flask.request.args.get('nid', default=None, type=str)
     cid = flask.request.args.get('cid', default=None, type=str)
     usid = flask.request.args.get('usid', default=None, type=str)
 
-    query = Message.select().where(Message.cmd==mysensors.Commands.C_SET)
+    query = tvalues_query(sort, nid, cid, usid)
+    return overlay_list( 'types.html', query, registry.overlay_tvalues, sort=sort, nid=nid, cid=cid, usid=usid )
 
-    # sort as requested
-    if sort=="cid": 
-        query = query.order_by(Message.cid)
-    elif sort=="date": 
-        query = query.order_by(Message.received.desc())
-    else: 
-        query = query.order_by(Message.nid, Message.cid)
-    	    
-    # filter if requested
+##----------------------------------------------------------------------------
+
+def filter_messages(query, nid=None, cid=None, usid=None):
+    """ restrict a Message query to one sensor, one node, or one child id
+    Args:
+        query (SelectQuery): Message query
+        nid (str): node id filter, '-' prefix means "all but", or None
+        cid (str): child id filter, '-' prefix means "all but", or None
+        usid (str): unique sensor id filter, or None
+    Returns:
+        SelectQuery: filtered query
+    """
     if usid is not None and len(usid)>0:
         iusid = int(usid)
         inid,icid = split_usid(iusid)
@@ -754,18 +3392,59 @@ def values():
             query = query.where(Message.cid==icid)
         else:
             query = query.where(Message.cid!=-icid)
-    return object_list( 'values.html', query, sort=sort, nid=nid, cid=cid, usid=usid )
+    return query
 
 ##----------------------------------------------------------------------------
 
-@app.route('/messages')
-def messages():
+def values_query(sort, nid=None, cid=None, usid=None, typ=None):
+    """ query for /values page
+    Args:
+        sort (str): 'usid', 'cid' or 'date'
+        nid, cid, usid (str): filters, see filter_messages()
+        typ (str): only this V_xxx type, or None
+    Returns:
+        SelectQuery: Message rows with cmd==C_SET
+    """
+    query = Message.select().where(Message.cmd==mysensors.Commands.C_SET)
+
+    # sort as requested
+    if sort=="cid": 
+        query = query.order_by(Message.cid)
+    elif sort=="date": 
+        query = query.order_by(Message.received.desc())
+    else: 
+        query = query.order_by(Message.nid, Message.cid)
+
+    if typ is not None and len(typ)>0:
+        query = query.where(Message.typ==int(typ))
+    return filter_messages(query, nid, cid, usid)
+
+@app.route('/values')
+def values():
     # get parameters
     sort = flask.request.args.get('sort', default="usid", type=str)
-    cid = flask.request.args.get('cid', default=None, type=str)
     nid = flask.request.args.get('nid', default=None, type=str)
+    cid = flask.request.args.get('cid', default=None, type=str)
     usid = flask.request.args.get('usid', default=None, type=str)
+    typ = flask.request.args.get('typ', default=None, type=str)
+
+    query = values_query(sort, nid, cid, usid, typ)
+    if sort=="date":
+        return keyset_list( 'values.html', query, Message, 
+            shards=archive.sources(query) + cold.sources(nid, cid, usid, mysensors.Commands.C_SET, typ), 
+            sort=sort, nid=nid, cid=cid, usid=usid, typ=typ )
+    return object_list( 'values.html', query, unlisted=unlisted_messages(), sort=sort, nid=nid, cid=cid, usid=usid, typ=typ )
 
+##----------------------------------------------------------------------------
+
+def messages_query(sort, nid=None, cid=None, usid=None):
+    """ query for /messages page
+    Args:
+        sort (str): 'nid', 'cid', 'cmd', 'typ' or 'date'
+        nid, cid, usid (str): filters, see filter_messages()
+    Returns:
+        SelectQuery: Message rows
+    """
     # sort as requested
     if sort=='nid':
         query = Message.select().order_by(Message.nid)
@@ -778,24 +3457,336 @@ def messages():
     else: 
         query = Message.select().order_by(Message.received.desc())
 
-    # filter if requested
-    if usid is not None and len(usid)>0:
-        iusid = int(usid)
-        query = query.where(Message.usid==iusid)
-    elif nid is not None and len(nid)>0:
-        inid = int(nid)
-        if inid >=0:
-            query = query.where(Message.nid==inid)
+    return filter_messages(query, nid, cid, usid)
+
+@app.route('/messages')
+def messages():
+    # get parameters
+    sort = flask.request.args.get('sort', default="usid", type=str)
+    cid = flask.request.args.get('cid', default=None, type=str)
+    nid = flask.request.args.get('nid', default=None, type=str)
+    usid = flask.request.args.get('usid', default=None, type=str)
+
+    query = messages_query(sort, nid, cid, usid)
+    if sort not in ('nid','cid','cmd','typ'):
+        unfiltered = not (nid or cid or usid)
+        return keyset_list( 'messages.html', query, Message, approx_total=unfiltered, 
+            shards=archive.sources(query) + cold.sources(nid, cid, usid),
+            sort=sort, nid=nid, cid=cid, usid=usid )
+    return object_list( 'messages.html', query, unlisted=unlisted_messages(), sort=sort, nid=nid, cid=cid, usid=usid )
+
+##----------------------------------------------------------------------------
+
+def stats_query(nid=None, ndays=14):
+    """ data for /stats page, from rollup tables only
+    Args:
+        nid (int): node and its sensors and value types, or None for all nodes
+        ndays (int): number of days with daily counts, up to today
+    Returns:
+        tuple: (list of dates, list of MessageStats rows). Each row has `nid`, `cid` and `typ` 
+               attributes as far as they apply, and `daily`, the list of counts per date
+    """
+    since = datetime.today().date() - timedelta(days=ndays-1)
+    dates = [ since + timedelta(days=i) for i in range(ndays) ]
+    if nid is None:
+        query = MessageStats.select().where(MessageStats.scope=='node')
+        counts = MessageCount.select().where(MessageCount.scope=='node')
+    else:
+        query = MessageStats.select().where(Rollup.where_node(MessageStats, nid))
+        counts = MessageCount.select().where(Rollup.where_node(MessageCount, nid))
+    rows = list( query.order_by(MessageStats.scope, usid_of_uvid(MessageStats.key), MessageStats.key) )
+    daily = collections.defaultdict(dict)
+    for c in counts.where(MessageCount.day >= since):
+        daily[(c.scope, c.key)][c.day] = c.count
+    for row in rows:
+        row.cid = row.typ = None
+        if row.scope == 'node':
+            row.nid = row.key
+        elif row.scope == 'sensor':
+            row.nid, row.cid = split_usid(row.key)
         else:
-            query = query.where(Message.nid!=-inid)
-    elif cid is not None and len(cid)>0:
-        icid = int(cid)
-        if (icid>=0):
-            query = query.where(Message.cid==icid)
+            row.nid, row.cid = split_usid(row.key % 1000000)
+            row.typ = row.key // 1000000
+        perday = daily.get((row.scope, row.key), {})
+        row.daily = [ perday.get(d, 0) for d in dates ]
+    return dates, rows
+
+@app.route('/stats')
+def stats():
+    nid = flask.request.args.get('nid', default=None, type=int)
+    ndays = flask.request.args.get('days', default=14, type=int)
+    dates, rows = stats_query(nid, ndays)
+    return render_template('stats.html', dates=dates, object_list=rows, nodes=registry.nodes, nid=nid, ndays=ndays)
+
+@app.route('/stats.json')
+def stats_json():
+    nid = flask.request.args.get('nid', default=None, type=int)
+    ndays = flask.request.args.get('days', default=14, type=int)
+    dates, rows = stats_query(nid, ndays)
+    return flask.jsonify(
+        days=[ d.isoformat() for d in dates ],
+        stats=[ dict(
+            scope=row.scope, key=row.key, nid=row.nid, cid=row.cid, typ=row.typ,
+            count=row.count, first=row.first.isoformat(), last=row.last.isoformat(),
+            min_interval=row.min_interval, avg_interval=row.avg_interval, max_interval=row.max_interval,
+            daily=row.daily ) for row in rows ] )
+
+##----------------------------------------------------------------------------
+
+@app.route('/alerts')
+def alerts():
+    return render_template('alerts.html', object_list=watch.current(), nodes=registry.nodes, 
+        factor=watch.factor, minimum=watch.minimum)
+
+@app.route('/alerts.json')
+def alerts_json():
+    return flask.jsonify( [ dict(
+        scope=row['scope'], nid=row['nid'], cid=row['cid'], last=isoformat(row['last']), 
+        usual_interval=row['usual'], overdue_since=isoformat(row['overdue']),
+        ) for row in watch.current() ] )
+
+##----------------------------------------------------------------------------
+
+@app.route('/series.json')
+def series_json():
+    """ time series of one value, for charts. Parameters: uvid, or nid+cid+typ; 
+        start and end as ISO date/time, default last `days` days; max. number of `points`
+    """
+    uvid = flask.request.args.get('uvid', default=None, type=int)
+    if uvid is None:
+        nid, cid, typ = ( flask.request.args.get(name, default=None, type=int) for name in ('nid','cid','typ') )
+        if None in (nid, cid, typ):
+            flask.abort(400, "uvid, or nid, cid and typ, are required")
+        uvid = make_uvid(nid, cid, typ)
+    days = flask.request.args.get('days', default=7, type=float)
+    end = datetime_arg('end') or datetime.now()
+    start = datetime_arg('start') or end - timedelta(days=days)
+    points = flask.request.args.get('points', default=SERIES_MAX_POINTS, type=int)
+    if points < 1:
+        flask.abort(400, "points must be at least 1")
+    bucket, rows = series.query(uvid, start, end, points)
+    return flask.jsonify( uvid=uvid, bucket=bucket, start=start.isoformat(), end=end.isoformat(),
+        columns=['time','min','avg','max'], points=rows )
+
+##----------------------------------------------------------------------------
+
+def datetime_arg(name):
+    """ request parameter in ISO format, answers 400 if it is malformed
+    Args:
+        name (str): parameter name
+    Returns:
+        datetime: value, or None if the parameter is missing or empty
+    """
+    text = flask.request.args.get(name, default=None, type=str)
+    if not text:
+        return None
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError:
+        flask.abort(400, "malformed {0} '{1}', ISO date/time expected".format(name, text))
+
+def export_query(kind, nid=None, cid=None, usid=None, since=None, until=None, typ=None):
+    """ query for export of messages, values (C_SET messages) or current values
+    Args:
+        kind (str): 'messages', 'values' or 'tvalues'
+        nid, cid, usid (str): filters, as for the /messages, /values and /tvalues pages
+        since (datetime): only rows received at or after this time, or None
+        until (datetime): only rows received before this time, or None
+        typ (str): V_xxx type filter for values, as for the /values page
+    Returns:
+        tuple: (query, primary key field, list of column names)
+    """
+    if kind == 'tvalues':
+        model = ValueType
+        columns = [ValueType.uvid, ValueType.nid, ValueType.cid, ValueType.typ, ValueType.value, ValueType.received]
+        query = tvalues_query('usid', nid, cid, usid)
+    else:
+        model = Message
+        columns = [Message.id, Message.received, Message.nid, Message.cid, Message.cmd, Message.typ, 
+                   Message.payload, Message.gateway]
+        query = values_query('usid', nid, cid, usid, typ) if kind == 'values' else messages_query('date', nid, cid, usid)
+    if since is not None:
+        query = query.where(model.received >= since)
+    if until is not None:
+        query = query.where(model.received < until)
+    pk = model._meta.primary_key
+    return query.select(*columns).order_by(pk), pk, [ c.name for c in columns ]
+
+def export_rows(query, pk, chunk=EXPORT_CHUNK):
+    """ run an export query in chunks of `chunk` rows, continuing after the last primary key seen.
+        Each chunk is a short query of its own, so memory use does not depend on the number of rows, 
+        and no read transaction stays open while the rows are sent
+    Args:
+        query (SelectQuery): query ordered by primary key, see export_query()
+        pk (Field): primary key field, must be the first column
+        chunk (int): rows per query
+    Yields:
+        list: tuples, one per row, up to `chunk` of them
+    """
+    last = None
+    while True:
+        page = query if last is None else query.where(pk > last)
+        rows = list( page.limit(chunk).tuples() )
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+        if len(rows) < chunk:
+            return
+
+def export_lines(chunks, columns, fmt):
+    """ format exported rows as CSV with header line, or as JSON lines
+    Args:
+        chunks (iterable): lists of row tuples, see export_rows()
+        columns (list): column names
+        fmt (str): 'csv' or 'jsonl'
+    Yields:
+        str: formatted lines for one chunk of rows
+    """
+    def value(v):
+        return v.isoformat() if isinstance(v, datetime) else v
+
+    if fmt == 'csv':
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(columns)
+        yield buf.getvalue()
+        for rows in chunks:
+            buf.seek(0)
+            buf.truncate()
+            writer.writerows( [ [value(v) for v in row] for row in rows ] )
+            yield buf.getvalue()
+    else:
+        for rows in chunks:
+            yield "".join( json.dumps(dict(zip(columns, map(value, row)))) + "\n" for row in rows )
+
+def export_chunks(kind, query, pk, columns, since=None, until=None, nid=None, cid=None, usid=None, typ=None):
+    """ export_rows() for the database and, for messages and values, the compressed blocks and 
+        the archived months that overlap the time range, oldest first
+    Args:
+        kind (str): 'messages', 'values' or 'tvalues'
+        query, pk, columns: see export_query()
+        since, until (datetime): time range, or None
+        nid, cid, usid, typ (str): filters, as for export_query()
+    Yields:
+        list: tuples, one per row
+    """
+    queries = [query]
+    if kind != 'tvalues':
+        cmd, typ = (mysensors.Commands.C_SET, typ) if kind == 'values' else (None, None)
+        for source, start, end in cold.sources(nid, cid, usid, cmd, typ):
+            yield from source.export(columns, since, until)
+        queries = [ q for q, start, end in reversed(archive.sources(query, since, until)) ] + queries
+    for q in queries:
+        yield from export_rows(q, pk)
+
+EXPORT_MIMETYPES = { 'csv': 'text/csv', 'jsonl': 'application/x-ndjson' }
+
+@app.route('/export/<kind>.<fmt>')
+def export(kind, fmt):
+    """ download messages, values or current values as CSV or JSON lines, with the same filters
+        as the pages, and `since`/`until` in ISO format. The response is streamed
+    """
+    if kind not in ('messages','values','tvalues') or fmt not in EXPORT_MIMETYPES:
+        flask.abort(404)
+    since = datetime_arg('since')
+    until = datetime_arg('until')
+    nid = flask.request.args.get('nid', default=None, type=str)
+    cid = flask.request.args.get('cid', default=None, type=str)
+    usid = flask.request.args.get('usid', default=None, type=str)
+    typ = flask.request.args.get('typ', default=None, type=str)
+    query, pk, columns = export_query(kind, nid, cid, usid, since, until, typ)
+    lines = export_lines( export_chunks(kind, query, pk, columns, since, until, nid, cid, usid, typ), columns, fmt )
+    return flask.Response( flask.stream_with_context(lines), mimetype=EXPORT_MIMETYPES[fmt],
+        headers={'Content-Disposition': 'attachment; filename="{0}.{1}"'.format(kind, fmt)} )
+
+##----------------------------------------------------------------------------
+
+def cached_by_version(view):
+    """ decorator for read-only views of nodes, sensors and values: responses carry an ETag 
+        from Registry.etag(), and a request with a matching If-None-Match header is answered 
+        with 304 Not Modified, without any database query
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # take the tag before querying, so a change during the query is seen by the next request
+        etag = registry.etag()
+        if request.if_none_match.contains(etag):
+            response = flask.Response(status=304)
         else:
-            query = query.where(Message.cid!=-icid)
+            response = flask.make_response( view(*args, **kwargs) )
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+def isoformat(dt):
+    """ date or datetime as ISO string, or None """
+    return dt.isoformat() if dt is not None else None
+
+@app.route('/api/nodes')
+@cached_by_version
+def api_nodes():
+    rows = list( nodes_query('nid').objects() )
+    registry.overlay_nodes(rows)
+    return flask.jsonify( [ dict(
+        nid=row.nid, sk_name=row.sk_name, sk_version=row.sk_version, sk_revision=row.sk_revision,
+        api_ver=row.api_ver, lastseen=isoformat(row.lastseen), location=row.location,
+        bat_changed=isoformat(row.bat_changed), bat_level=row.level, parent=row.parent, arc=row.arc,
+        ) for row in rows ] )
+
+@app.route('/api/sensors')
+@cached_by_version
+def api_sensors():
+    nid = flask.request.args.get('nid', default=None, type=int)
+    rows = list( Sensor.select().where(Sensor.nid==nid) if nid is not None else Sensor.select() )
+    registry.overlay_sensors(rows)
+    return flask.jsonify( [ dict(
+        usid=row.usid, nid=row.nid_id, cid=row.cid, typ=row.typ, typ_name=mysensors.sensor_names.get(row.typ),
+        name=row.name, lastseen=isoformat(row.lastseen),
+        values=[ name or typ for typ, name in value_types(row.values) ],
+        ) for row in rows ] )
+
+@app.route('/api/tvalues')
+@cached_by_version
+def api_tvalues():
+    nid = flask.request.args.get('nid', default=None, type=int)
+    usid = flask.request.args.get('usid', default=None, type=int)
+    query = ValueType.select()
+    if usid is not None:
+        query = query.where(ValueType.usid==usid)
+    elif nid is not None:
+        query = query.where(ValueType.nid==nid)
+    rows = list(query)
+    registry.overlay_tvalues(rows)
+    return flask.jsonify( [ dict(
+        uvid=row.uvid, usid=row.usid_id, nid=row.nid_id, cid=row.cid, typ=row.typ, 
+        typ_name=mysensors.value_names.get(row.typ), value=row.value, received=isoformat(row.received),
+        ) for row in rows ] )
+
+##----------------------------------------------------------------------------
 
-    return object_list( 'messages.html', query, sort=sort, nid=nid, cid=cid, usid=usid )
+@app.route('/live')
+def live_view():
+    nid = flask.request.args.get('nid', default=None, type=int)
+    cid = flask.request.args.get('cid', default=None, type=int)
+    cmd = flask.request.args.get('cmd', default=None, type=int)
+    return render_template('live.html', nid=nid, cid=cid, cmd=cmd)
+
+@app.route('/live/stream')
+def live_stream():
+    """ Server-Sent Events with incoming messages, filtered by nid, cid, cmd. 
+        Does not use the database, the stream is fed by on_message()
+    """
+    sub = live.subscribe(
+        nid=flask.request.args.get('nid', default=None, type=int),
+        cid=flask.request.args.get('cid', default=None, type=int),
+        cmd=flask.request.args.get('cmd', default=None, type=int) )
+    if sub is None:
+        return flask.Response("too many live viewers", status=503, mimetype='text/plain')
+    # no stream_with_context(): the request, and its database connection, end before streaming
+    return flask.Response( live.stream(sub), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'} )
 
 ##----------------------------------------------------------------------------
 
@@ -813,6 +3804,36 @@ def battery_today():
         print (request )
     return redirect(url_for('batteries'))
 
+class QueryBudgetExceeded(Exception):
+    """ a page needed more SQL statements than allowed by QUERY_BUDGETS """
+    pass
+
+@app.before_request
+def before_request():
+    # each request gets a connection from the pool, returned in teardown_request()
+    db.connect(reuse_if_open=True)
+    db.reset_query_count()
+
+@app.teardown_request
+def teardown_request(exc):
+    if not db.is_closed():
+        db.close()
+
+@app.after_request
+def check_query_count(response):
+    """ report number of SQL statements in X-Query-Count header, and check it against QUERY_BUDGETS.
+        Statements on archived months do not count against the budget, their number depends 
+        on how many months a page spans
+    """
+    response.headers['X-Query-Count'] = str(db.query_count)
+    n = db.query_count - db.shard_query_count
+    budget = QUERY_BUDGETS.get(request.endpoint)
+    if budget is not None and n > budget:
+        applog.warning("%s needed %d SQL statements, budget is %d", request.full_path, n, budget)
+        if app.config.get('QUERY_BUDGET_STRICT'):
+            raise QueryBudgetExceeded("{0}: {1} SQL statements, budget is {2}".format(request.full_path, n, budget))
+    return response
+
 #endregion
 ##############################################################################
 #region Jinja helpers
@@ -848,15 +3869,7 @@ def my_processor():
         Returns:
             string: symbolic name like S_DOOR or V_STATUS
         """
-        if (cmd is None) or (typ is None): return None
-        if (cmd==mysensors.Commands.C_REQ) or (cmd==mysensors.Commands.C_SET):
-            return mysensors.value_names.get(typ)
-        elif (cmd==mysensors.Commands.C_PRESENTATION):
-            return mysensors.sensor_names.get(typ)
-        elif (cmd==mysensors.Commands.C_INTERNAL):
-            return mysensors.internal_names.get(typ)
-        else:
-            return None
+        return type_name(cmd,typ)
 
     def value_string(typ):
         """look up V_xxx symbolic name for value type
@@ -868,21 +3881,28 @@ def my_processor():
         if typ is None: return None
         return mysensors.value_names.get(typ)
 
-    def values_string(values: BigBitField):
+    def values_string(values: int):
         """return a list of symbolic names of values types sent by this sensor
         Args:
-            values (BigBitField): bit 0 set if type 0 found, etc
+            values (int): bit 0 set if type 0 found, etc
         Returns:
             string: comma-separated list of symbolic names
         """
-        vnames = []
-        for i in range(64):
-            if values.is_set(i):
-                vname = mysensors.value_names.get(i)
-                if vname is not None:
-                    vnames.append(vname)
-        return ", ".join(vnames)
+        return ", ".join( name for typ, name in value_types(values) if name is not None )
     
+    def interval_string(seconds):
+        """format an interval between messages
+        Args:
+            seconds (float): interval [s], or None
+        Returns:
+            string: like '45 s', '12.5 min', '3.0 h' or '2.1 d'
+        """
+        if seconds is None: return None
+        if seconds < 100: return "{0:.0f} s".format(seconds)
+        if seconds < 6000: return "{0:.1f} min".format(seconds/60)
+        if seconds < 2*86400: return "{0:.1f} h".format(seconds/3600)
+        return "{0:.1f} d".format(seconds/86400)
+
     def days_ago(dt: datetime):
         """calculate how many days ago a date was
         Args:
@@ -913,6 +3933,8 @@ def my_processor():
         type_string=type_string,
         value_string=value_string,
         values_string=values_string,
+        value_types=value_types,
+        interval_string=interval_string,
         days_ago=days_ago,
         months_ago=months_ago,
         )
@@ -986,7 +4008,7 @@ class ConfirmDeleteOldForm(wtf.Form):
         if (request.method=='POST'):
             ndays = int(request.form['f_ndays'])
             print ("Delete records older than {0} days".format(ndays))
-            delete_old_stuff(ndays)
+            maintenance.submit("delete_old_stuff", delete_old_stuff, ndays)
             return redirect(url_for('nodes'))
         # else if GET, then display form
         form.f_ndays.data = ndays
@@ -1043,6 +4065,7 @@ class LocationsForm(wtf.Form):
                     print("Error: " + str(err))
                     sys.exit(1)
                     raise
+            registry.changed()
             return redirect(url_for('nodes'))
         # else if GET, then display form
         nodes = Node.select().order_by(Node.nid)
@@ -1085,6 +4108,7 @@ class BatteriesForm(wtf.Form):
                     print("Error: " + str(err))
                     sys.exit(1)
                     raise
+            registry.changed()
             return redirect(url_for('nodes'))
         # else if GET, then display form
         nodes = Node.select().order_by(Node.nid)
@@ -1109,24 +4133,277 @@ def on_disconnect(client, userdata,  rc):
     applog.info("MQTT: disconnected")
 
 
-def main():
-    db.init(os.path.join(DB_DIR, DATABASE_FILE))
+def migrate_indexes():
+    """ add missing indexes listed in INDEXES. This may take a while on a large database
+    """
+    migrator = SqliteMigrator(db)
+    compact = messages_compacted()
+    for table, columns in INDEXES:
+        if table == 'message' and compact:
+            name = "messagedata_" + "_".join(columns)
+            if name not in [ ix.name for ix in db.get_indexes('messagedata') ]:
+                applog.info("Migration: add index on %s(%s), please wait ...", 'messagedata', ",".join(columns))
+                t0 = time.monotonic()
+                db.execute_sql( 'CREATE INDEX "{0}" ON "messagedata" ({1})'.format(
+                    name, ", ".join( COMPACT_COLUMNS[c] for c in columns ) ) )
+                applog.info("Migration: index added in %.1f s", time.monotonic()-t0)
+            continue
+        existing = [ tuple(ix.columns) for ix in db.get_indexes(table) ]
+        if columns not in existing:
+            applog.info("Migration: add index on %s(%s), please wait ...", table, ",".join(columns))
+            t0 = time.monotonic()
+            migrate( migrator.add_index(table, columns, False), )
+            applog.info("Migration: index added in %.1f s", time.monotonic()-t0)
+
+##----------------------------------------------------------------------------
+
+# Compact message storage: table 'messagedata' packs nid, cid, cmd and typ into one integer `key`, 
+# like make_usid() and make_uvid(), keeps `received` as milliseconds since epoch (of the naive local time), 
+# and refers to payload strings in table 'messagepayload' by id. 'message' becomes a view with the 
+# original columns, with INSTEAD OF triggers for INSERT, UPDATE and DELETE, so the Message model works unchanged. 
+# The view shows `received` as the integer itself, MessageTimeField converts, so filters and keyset cursors 
+# compare integers. The indexes in INDEXES are created on the expressions of the view columns, which SQLite 
+# can match; apart from the plain `ms`, these are integer arithmetic on `key`.
+
+COMPACT_COLUMNS = {
+    'id':       "id",
+    'nid_id':   "key / 10000000",
+    'cid':      "key / 10000 % 1000",
+    'cmd':      "key / 1000 % 10",
+    'typ':      "key % 1000",
+    'payload':  "(SELECT p.text FROM messagepayload AS p WHERE p.id = pid)",
+    'received': "ms",
+    'gateway':  "gateway",
+}
+
+def compact_key(row):
+    """ SQL expression packing nid, cid, cmd and typ of `row` (e.g. 'NEW') into one integer """
+    return "(({0}.nid_id*1000 + {0}.cid)*10 + {0}.cmd)*1000 + {0}.typ".format(row)
+
+def compact_ms(received):
+    """ SQL expression converting a DateTimeField string to milliseconds since epoch """
+    return "CAST(round((julianday({0}) - 2440587.5) * 86400000) AS INTEGER)".format(received)
+
+def compact_received(received):
+    """ SQL expression for `received` of a new row: milliseconds from MessageTimeField, or a DateTimeField string """
+    return "CASE WHEN typeof({0}) = 'text' THEN {1} ELSE {0} END".format(received, compact_ms(received))
+
+def compact_pid(payload):
+    """ SQL expression for the id of a payload string in the dictionary """
+    return "(SELECT id FROM messagepayload WHERE text = {0})".format(payload)
+
+def messages_compacted():
+    """
+    Returns:
+        bool: True if messages are stored in compact form
+    """
+    return db.table_exists('messagedata')
+
+def message_time(received):
+    """ arguments for SQLite date and time functions, e.g. fn.date(*message_time(Message.received))
+    Args:
+        received (Node): Message.received, or an expression of it
+    """
+    if Message.received.compact:
+        return (received / 1000.0, 'unixepoch')
+    return (received,)
+
+def message_datetime(received):
+    """ SQL expression for Message.received, or an expression of it, as DateTimeField string
+    """
+    if Message.received.compact:
+        return fn.strftime('%Y-%m-%d %H:%M:%f', *message_time(received))
+    return received
+
+def create_compact_view():
+    """ (re)create view 'message' on the compact tables, with its triggers
+    """
+    for name in ('message_insert', 'message_update', 'message_delete'):
+        db.execute_sql('DROP TRIGGER IF EXISTS "{0}"'.format(name))
+    db.execute_sql('DROP VIEW IF EXISTS "message"')
+    db.execute_sql('CREATE VIEW "message" AS SELECT {0} FROM "messagedata"'.format(
+        ", ".join( '{0} AS "{1}"'.format(expr, name) for name, expr in COMPACT_COLUMNS.items() ) ))
+    newrow = '{0}, {1}, {2}, NEW.gateway'.format( compact_key('NEW'), compact_pid('NEW.payload'), compact_received('NEW.received') )
+    db.execute_sql('CREATE TRIGGER "message_insert" INSTEAD OF INSERT ON "message" BEGIN '
+                   'INSERT OR IGNORE INTO "messagepayload" ("text") VALUES (NEW.payload); '
+                   'INSERT INTO "messagedata" ("id", "key", "pid", "ms", "gateway") VALUES (NEW.id, {0}); END'.format(newrow))
+    db.execute_sql('CREATE TRIGGER "message_update" INSTEAD OF UPDATE ON "message" BEGIN '
+                   'INSERT OR IGNORE INTO "messagepayload" ("text") VALUES (NEW.payload); '
+                   'UPDATE "messagedata" SET ("key", "pid", "ms", "gateway") = ({0}) WHERE "id" = OLD.id; END'.format(newrow))
+    db.execute_sql('CREATE TRIGGER "message_delete" INSTEAD OF DELETE ON "message" BEGIN '
+                   'DELETE FROM "messagedata" WHERE "id" = OLD.id; END')
+
+def migrate_compact_view():
+    """ migrate older compact form, where the view showed `received` as text: recreate the view, 
+        and replace the indexes on text expressions
+    Returns:
+        bool: True if migrated
+    """
+    view = db.execute_sql("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = 'message'").fetchone()
+    if view is None or 'strftime' not in view[0]:
+        return False
+    with db.writer():
+        for ix in db.get_indexes('messagedata'):
+            if 'strftime' in (ix.sql or ''):
+                db.execute_sql('DROP INDEX "{0}"'.format(ix.name))
+        create_compact_view()
+    migrate_indexes()
+    db.execute_sql('ANALYZE "messagedata"')
+    applog.info("Migration: message view shows `received` in milliseconds")
+    return True
+
+def compact_messages():
+    """ convert table 'message' to compact storage, see COMPACT_COLUMNS. 
+        Done in one transaction, then the database file is vacuumed to release the space
+    Returns:
+        dict: number of messages and payload strings, file size before and after
+    """
+    def filesize():
+        return db.execute_sql("SELECT page_count * page_size FROM pragma_page_count(), pragma_page_size()").fetchone()[0]
+
+    before = filesize()
+    t0 = time.monotonic()
+    applog.info("Migration: converting messages to compact storage, please wait ...")
+    with db.writer():
+        db.execute_sql('CREATE TABLE "messagepayload" ("id" INTEGER NOT NULL PRIMARY KEY, "text" TEXT NOT NULL UNIQUE)')
+        db.execute_sql('INSERT INTO "messagepayload" ("text") SELECT DISTINCT "payload" FROM "message"')
+        db.execute_sql('CREATE TABLE "messagedata" ("id" INTEGER NOT NULL PRIMARY KEY, "key" INTEGER NOT NULL, '
+                       '"pid" INTEGER NOT NULL, "ms" INTEGER NOT NULL, "gateway" TEXT)')
+        db.execute_sql('INSERT INTO "messagedata" ("id", "key", "pid", "ms", "gateway") '
+                       'SELECT m.id, {0}, p.id, {1}, m.gateway FROM "message" AS m '
+                       'JOIN "messagepayload" AS p ON p.text = m.payload ORDER BY m.id'.format(
+                       compact_key('m'), compact_ms('m.received')))
+        db.execute_sql('DROP TABLE "message"')
+        create_compact_view()
+        nmessages = db.execute_sql('SELECT count(*) FROM "messagedata"').fetchone()[0]
+        npayloads = db.execute_sql('SELECT count(*) FROM "messagepayload"').fetchone()[0]
+    Message.received.compact = True
+    archive.compact_times()
+    migrate_indexes()
+    # without statistics, SQLite cannot tell the indexes on expressions apart and may pick the one on cmd
+    db.execute_sql('ANALYZE "messagedata"')
+    db.execute_sql('VACUUM')
+    after = filesize()
+    applog.info("Migration: %d messages with %d distinct payloads converted in %.1f s, database %.1f MB -> %.1f MB", 
+        nmessages, npayloads, time.monotonic()-t0, before/1e6, after/1e6)
+    return dict(messages=nmessages, payloads=npayloads, before=before, after=after)
+
+##----------------------------------------------------------------------------
+
+def explain_queries():
+    """ print the SQLite query plans for the queries used by the web pages and delete functions,
+        and flag full table scans
+    Returns:
+        int: number of queries that need a full table scan
+    """
+    C_SET, C_REQ = mysensors.Commands.C_SET, mysensors.Commands.C_REQ
+    cutoff = datetime.today()-timedelta(days=365)
+    checks = [
+        ("/nodes",                      nodes_query('nid')),
+        ("/nodes?sort=date",            nodes_query('date')),
+        ("/sensors",                    sensors_query('usid')),
+        ("/sensors?nid=1",              sensors_query('usid', 1)),
+        ("/tvalues",                    tvalues_query('usid')),
+        ("/tvalues?sort=date",          tvalues_query('date')),
+        ("/values",                     values_query('usid')),
+        ("/values?sort=date",           values_query('date')),
+        ("/values?nid=1",               values_query('usid', nid='1')),
+        ("/values?usid=1001",           values_query('usid', usid='1001')),
+        ("/values?sort=date&cid=1",     values_query('date', cid='1')),
+        ("/messages",                   messages_query('date')),
+        ("/messages?nid=1",             messages_query('date', nid='1')),
+        ("/messages?usid=1001",         messages_query('date', usid='1001')),
+        ("/messages?sort=cmd",          messages_query('cmd')),
+        ("delete_node_requests()",      Message.delete().where( (Message.nid==1) & (Message.cmd==C_REQ) )),
+        ("delete_sensor()",             Message.delete().where( (Message.nid==1) & (Message.cid==1) )),
+        ("delete_old_stuff() messages", Message.select(Message.id).where( Message.received < cutoff ).limit(RETENTION_CHUNK)),
+        ("delete_old_stuff() values",   ValueType.delete().where( ValueType.received < cutoff )),
+    ]
+    nscans = 0
+    for label, query in checks:
+        if isinstance(query, Select) and query._limit is None:
+            query = query.paginate(1, 20)
+        sql, params = query.sql()
+        print(label)
+        for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params):
+            detail = row[-1]
+            isscan = detail.startswith('SCAN') and ' USING ' not in detail
+            if isscan:
+                nscans += 1
+            print("    {0}{1}".format(detail, "   <-- full table scan" if isscan else ""))
+    print("{0} queries checked, {1} full table scans".format(len(checks), nscans))
+    return nscans
+
+##----------------------------------------------------------------------------
+
+# pages with various parameters, for check_queries() and tests/test_query_budgets.py
+BUDGET_CHECK_URLS = [
+    '/nodes', '/nodes?sort=date', '/sensors', '/sensors?sort=date', '/sensors?nid=1', '/sensors?typ=0',
+    '/tvalues', '/tvalues?sort=date', '/tvalues?nid=1', 
+    '/values', '/values?sort=date', '/values?nid=1', '/values?sort=date&nid=-1', '/values?typ=0&sort=date',
+    '/messages', '/messages?nid=1', '/messages?sort=cmd', '/messages?after=' + KeysetPage.START,
+    '/stats', '/stats?nid=1', '/stats.json', '/series.json?uvid=3001255', '/series.json?uvid=3001255&days=365',
+    '/api/nodes', '/api/sensors', '/api/sensors?nid=1', '/api/tvalues', '/api/tvalues?nid=1',
+    '/alerts', '/alerts.json',
+]
+
+def check_queries(urls=BUDGET_CHECK_URLS):
+    """ request all pages, with various parameters, and check number of SQL statements 
+        against QUERY_BUDGETS
+    Args:
+        urls (list): pages to request
+    Returns:
+        int: number of pages that exceeded their budget
+    """
+    app.config['QUERY_BUDGET_STRICT'] = True
+    client = app.test_client()
+    nfail = 0
+    for url in urls:
+        try:
+            response = client.get(url)
+            print("{0:30} {1:>3} SQL statements".format(url, response.headers.get('X-Query-Count')))
+        except QueryBudgetExceeded as err:
+            nfail += 1
+            print("{0:30} FAILED: {1}".format(url, err))
+    print("{0} pages checked, {1} over budget".format(len(urls), nfail))
+    return nfail
+
+##----------------------------------------------------------------------------
+
+def open_database(path=None):
+    """ open the database, create tables and migrate older database versions if necessary
+    Args:
+        path (str): database file, or None for default location
+    """
+    path = path or os.path.join(DB_DIR, DATABASE_FILE)
+    db.init(
+        path,
+        max_connections=DB_MAX_CONNECTIONS,
+        stale_timeout=300,
+        check_same_thread=False,        # pooled connections may be reused by another thread
+        pragmas={
+            'journal_mode': 'wal',
+            'synchronous': 'normal',
+            'busy_timeout': DB_BUSY_TIMEOUT,
+        })
     db.connect()
-    tables = [Node,Sensor,ValueType,Message]
+    tables = [Node,Sensor,ValueType,Message,MessageCount,MessageStats,Sample,SampleAgg]
+    if messages_compacted():
+        tables.remove(Message)          # is a view
     db.create_tables(tables)
     applog.info("opened database")
 
     introspector = Introspector.from_database(db)
     models = introspector.generate_models()
     if ('node' in models):
-        print("Table 'node' exists")
+        applog.debug("Table 'node' exists")
         dbnode = models['node']
 
         hasp = hasattr(dbnode,'parent')
         if (hasp):
-            print(" and it has a 'parent' field")
+            applog.debug(" and it has a 'parent' field")
         else:
-            print(" and it does NOT have a 'parent' field")
+            applog.debug(" and it does NOT have a 'parent' field")
             migrator = SqliteMigrator(db)
             parent = IntegerField(null=True, help_text="parent node Id")
             migrate( migrator.add_column('node', 'parent', parent), )
@@ -1134,16 +4411,57 @@ def main():
 
         hasArc = hasattr(dbnode,'arc')
         if (hasArc):
-            print(" and it has a 'arc' field")
+            applog.debug(" and it has a 'arc' field")
         else:
-            print(" and it does NOT have a 'arc' field")
+            applog.debug(" and it does NOT have a 'arc' field")
             migrator = SqliteMigrator(db)
             arc = IntegerField(null=True, help_text="ARC success rate [%]")
             migrate( migrator.add_column('node', 'arc', arc), )
             applog.info("Migration: add field 'arc'")
 
+    if ('message' in models) and not hasattr(models['message'],'gateway'):
+        migrator = SqliteMigrator(db)
+        gateway = CharField( max_length=16, null=True, help_text="gateway that delivered the message")
+        migrate( migrator.add_column('message', 'gateway', gateway), )
+        applog.info("Migration: add field 'gateway'")
+
+    if Sensor.select().where(fn.typeof(Sensor.values)=='blob').exists():
+        migrate_value_types()
+
+    Message.received.compact = messages_compacted()
+    if Message.received.compact:
+        migrate_compact_view()
+    elif COMPACT_MESSAGES:
+        compact_messages()
+    migrate_indexes()
+    archive.open(path)
+    cold.open(path)
+
     if ValueType.select().count()==0:
-        fill_tvalues()
+        rebuild_tvalues()
+    registry.load()
+    if not MessageStats.select().exists() and Message.select().exists():
+        rebuild_stats()
+    rollup.load()
+    watch.load()
+
+##----------------------------------------------------------------------------
+
+def serve():
+    """ listen to MQTT and run web server
+    """
+    ingest.start()
+    applog.info("started ingest writer")
+
+    if RETENTION_POLICY.get('default') is not None or RETENTION_POLICY.get('commands') or RETENTION_POLICY.get('nodes'):
+        maintenance.every(RETENTION_INTERVAL, "retention", apply_retention_policy)
+    if any(keep is not None for bucket, keep in SERIES_TIERS):
+        maintenance.every(RETENTION_INTERVAL, "series retention", series.delete_old)
+    if MESSAGE_SHARDS:
+        maintenance.every(RETENTION_INTERVAL, "archive", archive.archive_old)
+    if COLD_AFTER_DAYS is not None:
+        maintenance.every(RETENTION_INTERVAL, "compress", cold.compress_old)
+    watch.start()
 
     mqttc = mqtt.Client()
     #mqttc.enable_logger(applog)
@@ -1156,6 +4474,87 @@ def main():
 
     app.run( debug=True, use_reloader=False, host='0.0.0.0' )
 
+##----------------------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Tracker for MySensors messages, with web viewer")
+    parser.add_argument('--db', default=None, help="database file (default: %s in %s)" % (DATABASE_FILE, DB_DIR))
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help="listen to MQTT and run web server (default)")
+    commands.add_parser('explain', help="show query plans used by the web pages")
+    commands.add_parser('check-queries', help="check number of SQL statements per page against QUERY_BUDGETS")
+    cmd = commands.add_parser('delete-old', help="delete messages and values older than NDAYS days")
+    cmd.add_argument('ndays', type=int)
+    commands.add_parser('retention', help="apply RETENTION_POLICY once")
+    cmd = commands.add_parser('export', help="write messages, values or current values as CSV or JSON lines")
+    cmd.add_argument('kind', choices=['messages','values','tvalues'])
+    cmd.add_argument('--format', choices=list(EXPORT_MIMETYPES), default='csv')
+    cmd.add_argument('--nid', default=None, help="node id, '-' prefix means all but this node")
+    cmd.add_argument('--cid', default=None, help="child id, '-' prefix means all but this child id")
+    cmd.add_argument('--usid', default=None, help="unique sensor id")
+    cmd.add_argument('--typ', default=None, help="V_xxx value type, for values")
+    cmd.add_argument('--since', default=None, type=datetime.fromisoformat, help="ISO date/time")
+    cmd.add_argument('--until', default=None, type=datetime.fromisoformat, help="ISO date/time")
+    cmd.add_argument('-o', '--output', default=None, help="output file, default stdout")
+    commands.add_parser('rebuild-stats', help="recompute message statistics from messages in database")
+    commands.add_parser('rebuild-tvalues', help="recompute current values from messages in database")
+    commands.add_parser('compact', help="convert messages to compact storage, see COMPACT_MESSAGES")
+    cmd = commands.add_parser('compress', help="compress old messages into blocks per node and day, see COLD_AFTER_DAYS")
+    cmd.add_argument('--days', type=int, default=COLD_AFTER_DAYS, help="compress messages older than this many days")
+    cmd = commands.add_parser('archive', help="move messages of past months to one file per month, see MESSAGE_SHARDS")
+    cmd.add_argument('--keep', type=int, default=SHARD_KEEP_MONTHS, help="months to keep in main database, including the current one")
+    cmd = commands.add_parser('replay', help="import captured MQTT traffic, e.g. from mosquitto_sub -v")
+    cmd.add_argument('file', nargs='+', help="capture file, or - for stdin")
+    cmd.add_argument('--batch', type=int, default=INGEST_BATCH_SIZE, help="messages per transaction")
+    args = parser.parse_args()
+
+    open_database(args.db)
+    if args.command == 'explain':
+        explain_queries()
+    elif args.command == 'check-queries':
+        sys.exit( 1 if check_queries() else 0 )
+    elif args.command == 'delete-old':
+        delete_old_stuff(args.ndays)
+    elif args.command == 'retention':
+        apply_retention_policy()
+    elif args.command == 'export':
+        query, pk, columns = export_query(args.kind, args.nid, args.cid, args.usid, args.since, args.until, args.typ)
+        out = open(args.output, 'w', encoding="utf-8", newline='') if args.output else sys.stdout
+        chunks = export_chunks(args.kind, query, pk, columns, args.since, args.until, args.nid, args.cid, args.usid, args.typ)
+        for lines in export_lines( chunks, columns, args.format ):
+            out.write(lines)
+        if args.output:
+            out.close()
+    elif args.command == 'rebuild-stats':
+        rebuild_stats()
+    elif args.command == 'rebuild-tvalues':
+        print("{0} current values rebuilt".format(rebuild_tvalues()))
+    elif args.command == 'archive':
+        n = archive.archive_old(args.keep)
+        print("{0} messages moved, archived months: {1}".format(n, 
+            ", ".join("{0:%Y-%m}".format(m) for m in archive.months()) or "none"))
+    elif args.command == 'compress':
+        if args.days is not None:
+            cold.compress_old(args.days)
+        r = cold.stats()
+        print("{messages} messages in {blocks} blocks, {0:.1f} MB -> {1:.1f} MB, ratio {2:.1f}".format(
+            r['size']/1e6, r['compressed']/1e6, r['size']/max(1, r['compressed']), **r))
+    elif args.command == 'compact':
+        if messages_compacted():
+            print("messages are already stored in compact form")
+        else:
+            r = compact_messages()
+            print("{messages} messages, {payloads} distinct payloads, database {0:.1f} MB -> {1:.1f} MB".format(
+                r['before']/1e6, r['after']/1e6, **r))
+    elif args.command == 'replay':
+        for name in args.file:
+            with (open(sys.stdin.fileno(), encoding="utf-8", closefd=False) if name=='-' else open(name, encoding="utf-8")) as f:
+                stats = replay(f, args.batch)
+            print("{0}: {lines} lines, {written} messages written, {skipped} skipped, {duplicates} duplicates, "
+                  "{seconds} s, {per_second} messages/s".format(name, **stats))
+    else:
+        serve()
+
 
 if __name__ == '__main__':
     main()
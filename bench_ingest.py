@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# @file          bench_ingest.py
+#
+# Benchmark: how many MQTT messages per second the tracker can store
+
+#
+#   This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#   If a copy of the MPL was not distributed with this file, You can obtain one at http://mozilla.org/MPL/2.0/
+#
+#   SPDX-License-Identifier: MPL-2.0
+#
+
+import os, sys, time, random, tempfile, argparse, json
+from datetime import datetime
+
+import app
+import mysensors
+
+C = mysensors.Commands
+I = mysensors.Internal
+S = mysensors.Sensors
+V = mysensors.Values
+
+# (sensor type, value type, function returning a payload) for the children of a node
+CHILD_KINDS = [
+    (S.S_TEMP,     V.V_TEMP,       lambda rnd: "{0:.1f}".format(rnd.uniform(15,25))),
+    (S.S_HUM,      V.V_HUM,        lambda rnd: "{0:.0f}".format(rnd.uniform(30,70))),
+    (S.S_DOOR,     V.V_TRIPPED,    lambda rnd: str(rnd.randint(0,1))),
+    (S.S_BINARY,   V.V_STATUS,     lambda rnd: str(rnd.randint(0,1))),
+    (S.S_MOISTURE, V.V_LEVEL,      lambda rnd: str(rnd.randint(0,100))),
+]
+
+# share of each command in the generated traffic, roughly as seen in the author's setup
+DEFAULT_MIX = "set=80,internal=12,presentation=5,req=3"
+
+##----------------------------------------------------------------------------
+
+class FakeMessage:
+    """ stand-in for paho.mqtt.client.MQTTMessage """
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+class FakeClient:
+    """ stand-in for paho.mqtt.client.Client, calls on_message() for each message, like the paho network thread
+    """
+    def __init__(self, on_message):
+        self.on_message = on_message
+
+    def deliver(self, messages):
+        """ deliver messages one after the other
+        Args:
+            messages (list): (topic, payload) tuples
+        Returns:
+            list: time [s] spent in on_message() per message
+        """
+        latencies = []
+        clock = time.perf_counter
+        for topic, payload in messages:
+            msg = FakeMessage(topic, payload)
+            t0 = clock()
+            self.on_message(self, None, msg)
+            latencies.append( clock()-t0 )
+        return latencies
+
+##----------------------------------------------------------------------------
+
+def parse_mix(text):
+    """ parse a traffic mix like 'set=80,internal=12'
+    Returns:
+        dict: command name -> weight
+    """
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('set','internal','presentation','req'):
+            raise ValueError("unknown command '{0}' in mix".format(name))
+        mix[name] = float(weight)
+    return mix
+
+def generate(nmessages, nnodes, nchildren, mix, duplicates=0.1, seed=1):
+    """ generate synthetic MySensors traffic
+    Args:
+        nmessages (int): number of messages, without duplicates
+        nnodes (int): number of nodes
+        nchildren (int): number of children per node
+        mix (dict): command name -> weight
+        duplicates (float): fraction of messages that are also delivered by a second gateway
+        seed (int): random seed, so runs are comparable
+    Returns:
+        list: (topic, payload) tuples, payload as bytes
+    """
+    rnd = random.Random(seed)
+    nodes = list(range(1, nnodes+1))
+    names, weights = zip(*mix.items())
+    messages = []
+    for _ in range(nmessages):
+        nid = rnd.choice(nodes)
+        cid = rnd.randint(0, nchildren-1)
+        styp, vtyp, value = CHILD_KINDS[cid % len(CHILD_KINDS)]
+        kind = rnd.choices(names, weights)[0]
+        if kind == 'set':
+            cmd, typ, pay = C.C_SET, vtyp, value(rnd)
+        elif kind == 'req':
+            cmd, typ, pay = C.C_REQ, vtyp, ""
+        elif kind == 'presentation':
+            if rnd.random() < 0.2:
+                cid, cmd, typ, pay = 255, C.C_PRESENTATION, S.S_ARDUINO_NODE, "2.3.2"
+            else:
+                cmd, typ, pay = C.C_PRESENTATION, styp, "child {0}".format(cid)
+        else:
+            cid = 255
+            typ, pay = rnd.choice([
+                (I.I_BATTERY_LEVEL,  str(rnd.randint(0,100))),
+                (I.I_SKETCH_NAME,    "bench{0}".format(nid % 5)),
+                (I.I_SKETCH_VERSION, "$Rev: {0} $".format(800+nid % 7)),
+                (I.I_HEARTBEAT_RESPONSE, str(rnd.randint(0,10000))),
+            ])
+            cmd = C.C_INTERNAL
+        gw = rnd.randint(1,2)
+        key = "{0}/{1}/{2}/0/{3}".format(nid, cid, int(cmd), int(typ))
+        payload = pay.encode("utf-8")
+        messages.append( ("my/{0}/stat/{1}".format(gw, key), payload) )
+        if rnd.random() < duplicates:
+            messages.append( ("my/{0}/stat/{1}".format(3-gw, key), payload) )
+    return messages
+
+def percentile(values, p):
+    """ p-th percentile of a list of numbers, nearest rank """
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[ min(len(ordered)-1, int(round(p/100*(len(ordered)-1)))) ]
+
+##----------------------------------------------------------------------------
+
+def run_direct(messages, batch_size, spacing):
+    """ parse, de-duplicate and store messages in the calling thread,
+        in transactions of `batch_size` messages, like IngestWriter does.
+        Messages are timestamped `spacing` seconds apart, as if received live, 
+        so that duplicate removal only drops the copies from the second gateway
+    Returns:
+        dict: results
+    """
+    parser = app.TopicParser()
+    window = app.DedupWindow()
+    latencies = []
+    commits = []
+    clock = time.perf_counter
+    received = time.time() - len(messages)*spacing
+    app.db.reset_query_count()
+    t0 = clock()
+    for start in range(0, len(messages), batch_size):
+        with app.db.writer():
+            for i, (topic, payload) in enumerate(messages[start:start+batch_size], start):
+                t1 = clock()
+                now = received + i*spacing
+                rec = parser.parse(topic, payload)
+                if window.is_new(rec.key, rec.payload, rec.gw, now):
+                    app.handle_message(rec.nid, rec.cid, rec.cmd, rec.typ, rec.payload, datetime.fromtimestamp(now), rec.gw)
+                latencies.append( clock()-t1 )
+            t1 = clock()
+        commits.append( clock()-t1 )
+        app.flush_pending()
+    app.flush_pending(force=True)
+    elapsed = clock()-t0
+    return dict(
+        seconds=elapsed,
+        latencies=latencies,
+        statements=app.db.query_count,
+        commit_p50_ms=percentile(commits, 50)*1e3,
+        commit_p99_ms=percentile(commits, 99)*1e3,
+        )
+
+def run_mqtt(messages, batch_size):
+    """ deliver messages to on_message() through a fake MQTT client, with the ingest writer thread running.
+        Latency is the time the MQTT network thread spends per message,
+        throughput is measured until the last message is written.
+        As all messages arrive within a few seconds, duplicate removal also drops 
+        repeated values that would be stored in live traffic
+    Returns:
+        dict: results
+    """
+    app.ingest = app.IngestWriter(maxsize=len(messages)+1, batch_size=batch_size)
+    app.ingest.start()
+    client = FakeClient(app.on_message)
+    clock = time.perf_counter
+    t0 = clock()
+    latencies = client.deliver(messages)
+    delivered = clock()-t0
+    maxdepth = app.ingest.queue.qsize()
+    app.ingest.stop()
+    elapsed = clock()-t0
+    return dict(
+        seconds=elapsed,
+        latencies=latencies,
+        statements=app.ingest.statements,
+        deliver_seconds=delivered,
+        queue_depth=maxdepth,
+        dropped=app.ingest.dropped,
+        )
+
+##----------------------------------------------------------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description="measure how many MQTT messages per second the tracker can store")
+    ap.add_argument('--mode', choices=['direct','mqtt'], default='direct',
+        help="direct: call handlers in this thread; mqtt: through on_message() and the ingest writer thread")
+    ap.add_argument('-n', '--messages', type=int, default=20000, help="number of messages")
+    ap.add_argument('--nodes', type=int, default=30, help="number of nodes")
+    ap.add_argument('--children', type=int, default=8, help="children per node")
+    ap.add_argument('--mix', default=DEFAULT_MIX, help="traffic mix, default %(default)s")
+    ap.add_argument('--duplicates', type=float, default=0.1, help="fraction of messages received by two gateways")
+    ap.add_argument('--spacing', type=float, default=0.5, help="seconds between messages, as timestamped in direct mode")
+    ap.add_argument('--batch', type=int, default=app.INGEST_BATCH_SIZE, help="messages per transaction")
+    ap.add_argument('--db', default=None, help="database file, default: new temporary file")
+    ap.add_argument('--seed', type=int, default=1)
+    ap.add_argument('--json', action='store_true', help="print results as JSON")
+    ap.add_argument('--output', default=None, help="append results as one JSON line to this file")
+    args = ap.parse_args()
+
+    app.applog.setLevel('WARNING')
+    messages = generate(args.messages, args.nodes, args.children, parse_mix(args.mix), args.duplicates, args.seed)
+
+    tmpdir = None
+    path = args.db
+    if path is None:
+        tmpdir = tempfile.TemporaryDirectory()
+        path = os.path.join(tmpdir.name, "bench.db")
+    app.open_database(path)
+    if args.mode == 'direct':
+        r = run_direct(messages, args.batch, args.spacing)
+    else:
+        app.db.close()
+        r = run_mqtt(messages, args.batch)
+    latencies = r.pop('latencies')
+    nstored = app.Message.select().count()
+    app.db.close()
+
+    results = dict(
+        revision=app.REVISION[1:-1].strip(),
+        mode=args.mode,
+        messages=len(messages),
+        stored=nstored,
+        nodes=args.nodes,
+        children=args.children,
+        mix=args.mix,
+        batch=args.batch,
+        per_second=round(len(messages)/r['seconds'], 1),
+        p50_us=round(percentile(latencies, 50)*1e6, 1),
+        p99_us=round(percentile(latencies, 99)*1e6, 1),
+        statements_per_message=round(r.pop('statements')/len(messages), 2),
+        **{ k: round(v, 3) if isinstance(v, float) else v for k, v in r.items() },
+        )
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(results) + '\n')
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print("{messages} messages ({stored} stored) from {nodes} nodes x {children} children, mode {mode}, batch {batch}".format(**results))
+        print("  throughput           {0:10.1f} messages/s".format(results['per_second']))
+        print("  latency p50          {0:10.1f} us".format(results['p50_us']))
+        print("  latency p99          {0:10.1f} us".format(results['p99_us']))
+        print("  SQL statements       {0:10.2f} per message".format(results['statements_per_message']))
+    if tmpdir is not None:
+        tmpdir.cleanup()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+#
+# @file          bench_parse.py
+#
+# Microbenchmark: cost of parsing one MQTT message in on_message()
+
+#
+#   This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0. 
+#   If a copy of the MPL was not distributed with this file, You can obtain one at http://mozilla.org/MPL/2.0/
+#
+#   SPDX-License-Identifier: MPL-2.0
+#
+
+import re, timeit, argparse, json
+
+import app
+
+# topics as seen in the author's setup
+SAMPLES = [
+    ('my/3/stat/106/61/1/0/23',     b'37'),             # C_SET V_LEVEL
+    ('my/2/stat/123/11/1/0/16',     b'1'),              # C_SET V_TRIPPED
+    ('my/1/stat/199/255/3/0/0',     b'87'),             # C_INTERNAL I_BATTERY_LEVEL
+    ('my/2/stat/123/255/3/0/12',    b'$Rev: 826 $'),    # C_INTERNAL I_SKETCH_VERSION
+    ('my/2/stat/199/81/0/0/37',     b'Gas flow&vol'),   # C_PRESENTATION
+    ('my/2/stat/110/98/1/0/47',     b'parent: 0'),      # C_SET, parent report
+    ('my/1/stat/110/1/2/0/2',       b''),               # C_REQ
+]
+
+LEGACY_PATTERN = r'my\/\w+\/stat\/(.+)'
+
+def parse_legacy(topic, payload):
+    """ the parsing code from on_message() before TopicParser, for comparison """
+    pay = payload.decode("utf-8")
+    m = re.search(LEGACY_PATTERN, topic)
+    if m is None:
+        return None
+    t = m.group(1)
+    path = t.split('/')
+    if (len(path) < 5):
+        return None
+    nid = int(path[0])
+    cid = int(path[1])
+    cmd = int(path[2])
+    typ = int(path[4])
+    val = payload.decode("utf-8")
+    return (t, nid, cid, cmd, typ, val)
+
+def bench(func, number):
+    """ time `func` over all SAMPLES
+    Returns:
+        float: nanoseconds per message, best of 5 runs
+    """
+    def run():
+        for topic, payload in SAMPLES:
+            func(topic, payload)
+    best = min( timeit.repeat(run, number=number, repeat=5) )
+    return best / (number*len(SAMPLES)) * 1e9
+
+def main():
+    ap = argparse.ArgumentParser(description="measure per-message cost of MQTT topic parsing")
+    ap.add_argument('-n', '--number', type=int, default=20000, help="iterations over all sample topics")
+    ap.add_argument('--json', action='store_true', help="print results as JSON")
+    args = ap.parse_args()
+
+    parser = app.TopicParser()
+    results = {
+        'legacy_ns': bench(parse_legacy, args.number),
+        'parser_ns': bench(parser.parse, args.number),
+        'dedup_ns':  bench(app.DedupWindow().is_new, args.number),
+    }
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print("per message, {0} topics x {1} iterations:".format(len(SAMPLES), args.number))
+        print("  legacy re.search + split  {0:8.0f} ns".format(results['legacy_ns']))
+        print("  TopicParser.parse()       {0:8.0f} ns".format(results['parser_ns']))
+        print("  DedupWindow.is_new()      {0:8.0f} ns".format(results['dedup_ns']))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+#
+# @file          bench_routes.py
+#
+# Benchmark: latency of the web pages, for databases of various sizes
+
+#
+#   This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#   If a copy of the MPL was not distributed with this file, You can obtain one at http://mozilla.org/MPL/2.0/
+#
+#   SPDX-License-Identifier: MPL-2.0
+#
+
+import os, sys, time, random, argparse, json
+from datetime import datetime, timedelta
+
+from peewee import chunked
+
+import app
+import mysensors
+from bench_ingest import CHILD_KINDS, DEFAULT_MIX, parse_mix, percentile
+
+C = mysensors.Commands
+
+##----------------------------------------------------------------------------
+
+def build(nmessages, nnodes, nchildren, days, mix, seed=1, chunk=5000):
+    """ fill an empty database with synthetic nodes, sensors, values and messages.
+        Messages are spread evenly over the last `days` days, ids in order of time, like live traffic
+    Args:
+        nmessages (int): number of messages
+        nnodes (int): number of nodes
+        nchildren (int): number of children per node
+        days (float): time span of messages
+        mix (dict): command name -> weight, see bench_ingest.parse_mix()
+        seed (int): random seed
+        chunk (int): rows per INSERT statement
+    """
+    rnd = random.Random(seed)
+    now = datetime.now()
+    start = now - timedelta(days=days)
+    step = timedelta(days=days) / max(1, nmessages)
+
+    with app.db.atomic():
+        nodes = [ dict(nid=nid, sk_name="bench{0}".format(nid % 5), sk_version="$Rev: 800 $", sk_revision=800,
+                       api_ver="2.3.2", lastseen=now) for nid in range(1, nnodes+1) ]
+        app.Node.insert_many(nodes).execute()
+        sensors = []
+        tvalues = []
+        for nid in range(1, nnodes+1):
+            for cid in range(nchildren):
+                styp, vtyp, value = CHILD_KINDS[cid % len(CHILD_KINDS)]
+                sensor = app.Sensor(usid=app.make_usid(nid,cid), nid=nid, cid=cid, typ=int(styp),
+                                    name="child {0}".format(cid), values=1 << int(vtyp), lastseen=now)
+                sensors.append(sensor.__data__)
+                tvalues.append( dict(uvid=app.make_uvid(nid,cid,int(vtyp)), usid=sensor.usid, nid=nid, cid=cid,
+                                     typ=int(vtyp), value=value(rnd), received=now) )
+        for rows in chunked(sensors, chunk // 10):
+            app.Sensor.insert_many(rows).execute()
+        for rows in chunked(tvalues, chunk // 10):
+            app.ValueType.insert_many(rows).execute()
+
+    names, weights = zip(*mix.items())
+    commands = { 'set': C.C_SET, 'internal': C.C_INTERNAL, 'presentation': C.C_PRESENTATION, 'req': C.C_REQ }
+    fields = [app.Message.nid, app.Message.cid, app.Message.cmd, app.Message.typ,
+              app.Message.payload, app.Message.received, app.Message.gateway]
+
+    def rows():
+        for i in range(nmessages):
+            nid = rnd.randint(1, nnodes)
+            cid = rnd.randint(0, nchildren-1)
+            styp, vtyp, value = CHILD_KINDS[cid % len(CHILD_KINDS)]
+            kind = rnd.choices(names, weights)[0]
+            cmd = commands[kind]
+            if kind == 'internal':
+                cid, typ, pay = 255, int(mysensors.Internal.I_BATTERY_LEVEL), str(rnd.randint(0,100))
+            elif kind == 'presentation':
+                typ, pay = int(styp), "child {0}".format(cid)
+            else:
+                typ, pay = int(vtyp), value(rnd) if kind == 'set' else ""
+            yield (nid, cid, int(cmd), typ, pay, start + i*step, str(rnd.randint(1,2)))
+
+    t0 = time.monotonic()
+    written = 0
+    for batch in chunked(rows(), chunk):
+        with app.db.atomic():
+            app.Message.insert_many(batch, fields=fields).execute()
+        written += len(batch)
+        if written % (100*chunk) == 0:
+            print("  {0} of {1} messages, {2:.0f} s".format(written, nmessages, time.monotonic()-t0))
+
+##----------------------------------------------------------------------------
+
+def urls_for(nmessages, nnodes):
+    """ pages to request: every route, with the sort orders, filters and page depths that matter
+    Args:
+        nmessages (int): number of messages in database
+        nnodes (int): number of nodes in database
+    Returns:
+        list: URLs
+    """
+    nid = nnodes // 2 or 1
+    usid = app.make_usid(nid, 1)
+    lastpage = max(1, nmessages // 20)
+    # cursor of a message in the middle, for a deep keyset page
+    middle = app.Message.select().order_by(app.Message.id).offset(nmessages // 2).first()
+    cursor = app.KeysetPage.encode(middle) if middle is not None else app.KeysetPage.START
+    return [
+        '/nodes', '/nodes?sort=date',
+        '/sensors', '/sensors?sort=date', '/sensors?nid={0}'.format(nid), '/sensors?nid=-{0}'.format(nid),
+        '/tvalues', '/tvalues?sort=date', '/tvalues?nid={0}'.format(nid), '/tvalues?nid=-{0}'.format(nid),
+        '/values', '/values?sort=date', '/values?nid={0}'.format(nid), '/values?nid=-{0}'.format(nid),
+        '/values?usid={0}'.format(usid), '/values?sort=date&nid=-{0}'.format(nid),
+        '/values?page={0}'.format(lastpage // 2),
+        '/values?sort=date&before={0}'.format(cursor),
+        '/messages', '/messages?nid={0}'.format(nid), '/messages?nid=-{0}'.format(nid),
+        '/messages?usid={0}'.format(usid), '/messages?sort=cmd', '/messages?sort=nid',
+        '/messages?sort=cmd&page={0}'.format(lastpage // 2),
+        '/messages?before={0}'.format(cursor), '/messages?after={0}'.format(app.KeysetPage.START),
+    ]
+
+def bench_urls(urls, repeat):
+    """ request each URL `repeat` times, after one warm-up request
+    Returns:
+        list: dict per URL with status, SQL statements and latency percentiles [ms]
+    """
+    client = app.app.test_client()
+    results = []
+    for url in urls:
+        response = client.get(url)
+        times = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            response = client.get(url)
+            times.append( (time.perf_counter()-t0)*1e3 )
+        results.append(dict(
+            url=url,
+            status=response.status_code,
+            queries=int(response.headers.get('X-Query-Count', 0)),
+            p50_ms=round(percentile(times, 50), 2),
+            p95_ms=round(percentile(times, 95), 2),
+            p99_ms=round(percentile(times, 99), 2),
+            max_ms=round(max(times), 2),
+            ))
+    return results
+
+##----------------------------------------------------------------------------
+
+def main():
+    ap = argparse.ArgumentParser(description="measure latency of the web pages, for databases of various sizes")
+    ap.add_argument('--sizes', default="10000,100000,1000000", help="numbers of messages, comma-separated, default %(default)s")
+    ap.add_argument('--nodes', type=int, default=50, help="number of nodes")
+    ap.add_argument('--children', type=int, default=8, help="children per node")
+    ap.add_argument('--days', type=float, default=365, help="time span of messages")
+    ap.add_argument('--mix', default=DEFAULT_MIX, help="traffic mix, default %(default)s")
+    ap.add_argument('--dir', default="bench-db", help="directory for generated databases, which are reused by later runs")
+    ap.add_argument('--rebuild', action='store_true', help="generate databases even if they exist")
+    ap.add_argument('--repeat', type=int, default=20, help="requests per URL")
+    ap.add_argument('--json', action='store_true', help="print results as JSON")
+    ap.add_argument('--output', default=None, help="append results as JSON lines to this file")
+    args = ap.parse_args()
+
+    app.applog.setLevel('WARNING')
+    os.makedirs(args.dir, exist_ok=True)
+    sizes = [ int(n) for n in args.sizes.split(',') ]
+    allresults = []
+    for nmessages in sizes:
+        path = os.path.join(args.dir, "bench-{0}-{1}x{2}.db".format(nmessages, args.nodes, args.children))
+        if args.rebuild and os.path.exists(path):
+            os.remove(path)
+        exists = os.path.exists(path)
+        app.open_database(path)
+        if not exists:
+            print("building {0} ...".format(path))
+            t0 = time.monotonic()
+            build(nmessages, args.nodes, args.children, args.days, parse_mix(args.mix))
+            app.registry.load()
+            print("  built in {0:.0f} s".format(time.monotonic()-t0))
+        urls = urls_for(nmessages, args.nodes)
+        app.db.close()
+
+        results = bench_urls(urls, args.repeat)
+        for r in results:
+            r.update(revision=app.REVISION[1:-1].strip(), messages=nmessages, nodes=args.nodes, children=args.children)
+        allresults += results
+        if args.output:
+            with open(args.output, 'a') as f:
+                for r in results:
+                    f.write(json.dumps(r) + '\n')
+        if not args.json:
+            print("{0} messages, {1} nodes x {2} children, {3} requests per URL".format(
+                nmessages, args.nodes, args.children, args.repeat))
+            print("  {0:50} {1:>6} {2:>4} {3:>9} {4:>9} {5:>9}".format('URL', 'status', 'SQL', 'p50 ms', 'p95 ms', 'p99 ms'))
+            for r in results:
+                print("  {url:50.50} {status:>6} {queries:>4} {p50_ms:9.2f} {p95_ms:9.2f} {p99_ms:9.2f}".format(**r))
+        app.db.close_all()
+    if args.json:
+        print(json.dumps(allresults))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# @file          test_query_budgets.py
+#
+# Test: every page stays within its number of SQL statements, see app.QUERY_BUDGETS
+
+#
+#   This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+#   If a copy of the MPL was not distributed with this file, You can obtain one at http://mozilla.org/MPL/2.0/
+#
+#   SPDX-License-Identifier: MPL-2.0
+#
+
+import os, sys
+from datetime import datetime, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app
+import mysensors
+from bench_ingest import DEFAULT_MIX, parse_mix
+from bench_routes import build, urls_for
+
+NMESSAGES, NNODES, NCHILDREN = 2000, 5, 4
+
+##----------------------------------------------------------------------------
+
+@pytest.fixture(scope='module')
+def client(tmp_path_factory):
+    """ test client on a small database with nodes, sensors, values, messages, statistics and a time series
+    """
+    app.applog.setLevel('WARNING')
+    app.open_database( str(tmp_path_factory.mktemp('db') / 'budget.db') )
+    build(NMESSAGES, NNODES, NCHILDREN, 30, parse_mix(DEFAULT_MIX))
+    app.registry.load()
+    app.rebuild_stats()
+    now = datetime.now()
+    for i in range(100):
+        app.series.add(1, 255, int(mysensors.Values.V_PERCENTAGE), str(100-i//2), now - timedelta(hours=i))
+    app.series.flush()
+    app.app.config['QUERY_BUDGET_STRICT'] = False     # the test checks the header itself
+    yield app.app.test_client()
+    app.db.close_all()
+
+def endpoint(url):
+    return app.app.url_map.bind('localhost').match(url.split('?')[0])[0]
+
+##----------------------------------------------------------------------------
+
+def test_every_budget_is_checked():
+    checked = set( endpoint(url) for url in app.BUDGET_CHECK_URLS )
+    assert set(app.QUERY_BUDGETS) <= checked
+
+@pytest.mark.parametrize('url', app.BUDGET_CHECK_URLS)
+def test_page_within_budget(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    assert int(response.headers['X-Query-Count']) <= app.QUERY_BUDGETS[endpoint(url)]
+
+def test_bench_pages_within_budget(client):
+    for url in urls_for(NMESSAGES, NNODES):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert int(response.headers['X-Query-Count']) <= app.QUERY_BUDGETS[endpoint(url)], url